@@ -24,6 +24,9 @@ from logging import handlers
 import os
 import stat
 import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 
 import httplib2
 
@@ -189,21 +192,22 @@ def get_config():
     return irc_args, git_repos
 
 
-def process_hooks(hook_list, irc_data, git_hook_path, git_headers,
-                  git_event_data, git_repo, irc_hook=False):
-    """Iterate through the identified hooks and attempt to find IRC hooks.
+def plan_hooks(hook_list, irc_data, git_hook_path, git_event_data,
+               git_repo):
+    """Compare the repo hooks with our IRC hook and return the changes needed.
 
-    If this process does not find a predefined IRC hook it will attempt to
-    fix the repository and setup an IRC hook for our application.
+    Nothing is sent to github here, the changes are applied together once
+    the hooks of every repo are known.
 
     :param hook_list: ``list``
     :param irc_data:  ``dict``
-    :param git_hook_path: ``dict``
-    :param git_headers: ``dict``
+    :param git_hook_path: ``str``
     :param git_event_data: ``dict``
     :param git_repo: ``dict``
-    :param irc_hook: ``bol``
+    :return: ``list``
     """
+    changes = []
+    irc_hook = False
     for hook in hook_list:
         if isinstance(hook, dict) and hook.get('name') == 'irc':
             irc_hook = True
@@ -215,89 +219,96 @@ def process_hooks(hook_list, irc_data, git_hook_path, git_headers,
             LOG.debug('webhook data in git %s', json.dumps(hook, indent=2))
             if 'pull_request' not in hook_events:
                 LOG.warn(
-                    'IRC Hook not configured for [ pull_req ]'
-                    ' Attempting to FIXERATING'
-                )
-                resp, _content = HTTP.request(
-                    hook['url'],
-                    'PATCH',
-                    headers=git_headers,
-                    body=json.dumps(git_event_data)
+                    'IRC Hook for [ %s ] not configured for [ pull_req ]',
+                    git_repo['name']
                 )
-                if resp.status != 200:
-                    LOG.error(
-                        'FAILED TO UPDATE IRC HOOK FOR %s' % git_repo['name']
+                changes.append(
+                    _hook_change(
+                        git_repo, 'updated', hook['url'], 'PATCH',
+                        git_event_data, [200]
                     )
+                )
+                continue
+
+            hook_config = hook['config']
+            if hook['active'] is not True:
+                LOG.warn('Hook not active for [ %s ]', git_repo['name'])
+            elif hook['events'] != git_event_data['events']:
+                LOG.warn('Events out of sync for [ %s ]', git_repo['name'])
             else:
-                hook_config = hook['config']
-                if hook['active'] is not True:
-                    LOG.warn('Hook not active')
-                    _update_hook(
-                        git_hook_path,
-                        git_headers,
-                        irc_data,
-                        git_repo
-                    )
-                elif hook['events'] != git_event_data['events']:
-                    LOG.warn('Events out of sync')
-                    _update_hook(
-                        git_hook_path,
-                        git_headers,
-                        irc_data,
-                        git_repo
+                missing = [
+                    key for key in irc_data['config'] if key not in hook_config
+                ]
+                wrong = [
+                    key for key, value in irc_data['config'].items()
+                    if key in hook_config and value != hook_config[key]
+                ]
+                for key in missing:
+                    LOG.warn(
+                        'Configuration key [ %s ] seems to be missing', key
                     )
-                else:
-                    try:
-                        for key, value in irc_data['config'].items():
-                            if value != hook_config[key]:
-                                LOG.warn('Key [ %s ] not set correctly', key)
-                                _update_hook(
-                                    git_hook_path,
-                                    git_headers,
-                                    irc_data,
-                                    git_repo
-                                )
-                    except KeyError as exp:
-                        LOG.warn(
-                            'Configuration key [ %s ] seems to be missing', exp
-                        )
-                        _update_hook(
-                            git_hook_path,
-                            git_headers,
-                            irc_data,
-                            git_repo
-                        )
+                for key in wrong:
+                    LOG.warn('Key [ %s ] not set correctly', key)
+                if not missing and not wrong:
+                    continue
+
+            changes.append(
+                _hook_change(
+                    git_repo, 'updated', git_hook_path, 'POST', irc_data,
+                    range(200, 300)
+                )
+            )
 
     if not irc_hook:
         LOG.info(
-            'Repo [ %s ] does not have IRC hook configured'
-            ' CREATERATING a new hook.' % git_repo['name']
+            'Repo [ %s ] does not have IRC hook configured', git_repo['name']
         )
-        resp, _content = HTTP.request(
-            git_hook_path,
-            'POST',
-            headers=git_headers,
-            body=json.dumps(irc_data)
+        changes.append(
+            _hook_change(
+                git_repo, 'created', git_hook_path, 'POST', irc_data, [201]
+            )
         )
-        if resp.status != 201:
-            LOG.error('FAILED TO ADD IRC HOOK FOR [ %s ]' % git_repo['name'])
 
+    return changes
 
-def _update_hook(git_hook_path, git_headers, irc_data, git_repo):
-    LOG.warn(
-        'IRC hook is out of sync from known good config, UPDATERATING.'
+
+def _hook_change(git_repo, action, uri, method, body, expected):
+    return {
+        'repo': git_repo['name'],
+        'action': action,
+        'uri': uri,
+        'method': method,
+        'body': json.dumps(body),
+        'expected': expected
+    }
+
+
+def apply_change(change, headers):
+    """Send one planned hook change to github.
+
+    :param change: ``dict``
+    :param headers: ``dict``
+    :return: ``bol``
+    """
+    LOG.info(
+        'IRC hook for [ %s ] is out of sync from known good config,'
+        ' %s with a %s.', change['repo'],
+        'CREATERATING' if change['action'] == 'created' else 'UPDATERATING',
+        change['method']
     )
-    response, update_content = HTTP.request(
-        git_hook_path,
-        'POST',
-        headers=git_headers,
-        body=json.dumps(irc_data)
+    response, _content = http_request(
+        change['uri'],
+        change['method'],
+        headers=headers,
+        body=change['body']
     )
-    if response.status >= 300:
+    if response.status not in change['expected']:
         LOG.error(
             'FAILED TO ADD/MODIFY IRC HOOK FOR [ %s ] RETURN CODE [ %s ]',
-            git_repo['name'], response.status
+            change['repo'], response.status
         )
+        return False
+    return True
 
 
 def irc_json_data(irc_data):
@@ -334,69 +345,228 @@ def irc_json_data(irc_data):
     return data
 
 
+class TokenBucket(object):
+    """Hand out request slots at a steady rate across threads.
+
+    The bucket also follows the X-RateLimit headers github returns, once the
+    remaining requests run out every thread waits for the window to reset.
+    """
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.stamp = time.time()
+        self.remaining = None
+        self.reset = 0
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Block until a request may be sent."""
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(
+                    self.capacity, self.tokens + (now - self.stamp) * self.rate
+                )
+                self.stamp = now
+                if self.remaining is not None and self.remaining <= 0:
+                    if self.reset > now:
+                        wait = self.reset - now
+                        LOG.warn(
+                            'Github rate limit reached, waiting %d seconds',
+                            wait
+                        )
+                    else:
+                        # The window has passed, the next response tells us
+                        # the new limit
+                        self.remaining = None
+                        continue
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    if self.remaining is not None:
+                        self.remaining -= 1
+                    return
+                else:
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def update(self, response):
+        """Track the rate limit github reports.
+
+        :param response: ``object``
+        """
+        try:
+            remaining = int(response['x-ratelimit-remaining'])
+            reset = float(response['x-ratelimit-reset'])
+        except (KeyError, ValueError):
+            return
+
+        with self.lock:
+            if reset > self.reset or self.remaining is None:
+                self.remaining = remaining
+                self.reset = reset
+            else:
+                # Responses finish out of order, keep the lowest count seen
+                # for the current window
+                self.remaining = min(self.remaining, remaining)
+
+
+def private_cache_dir(path):
+    """Return path, created or tightened so only this user can read it.
+
+    Cached hook listings carry the IRC passwords of every repo.
+
+    :param path: ``str``
+    :return: ``str``
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path, 0o700)
+    os.chmod(path, 0o700)
+    return path
+
+
+def http_request(uri, method, headers, body=None):
+    """Send a request through this threads http client and the rate limit.
+
+    httplib2 clients are not thread safe so each thread gets its own, they
+    share one on disk cache that GET and HEAD responses are revalidated
+    against.
+
+    :param uri: ``str``
+    :param method: ``str``
+    :param headers: ``dict``
+    :param body: ``str``
+    :return: ``tuple``
+    """
+    if not hasattr(LOCAL, 'http'):
+        LOCAL.http = httplib2.Http(CACHE_DIR)
+    BUCKET.take()
+    response, content = LOCAL.http.request(
+        uri, method, headers=headers, body=body
+    )
+    if method in ('GET', 'HEAD'):
+        with STATS_LOCK:
+            CACHE_STATS['hits' if response.fromcache else 'misses'] += 1
+    if not response.fromcache:
+        # A cached reply carries the rate limit of when it was stored
+        BUCKET.update(response)
+    return response, content
+
+
+def run_pool(func, items):
+    """Call func on every item from a pool of WORKERS threads.
+
+    :param func: ``object``
+    :param items: ``list``
+    :return: ``list``
+    """
+    if not items:
+        return []
+    pool = ThreadPool(min(WORKERS, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+
 def get_repos(path, git_path, api_uri, headers):
     """Return a list of repositories from the provided github api.
 
+    Once the last page is known every page is fetched at the same time.
+
     :param path: ``str``
     :param git_path: ``str``
     :param api_uri: ``str``
     :param headers: ``dict``
     :return: ``list``
     """
-    response, content = HTTP.request(path, 'HEAD', headers=headers)
+    response, content = http_request(path, 'HEAD', headers=headers)
 
     if 'link' in response:
-        repo_content = []
         links = response['link'].split(',')
         pages = [i.replace(' ', '') for i in links if 'last' in i]
         page_link = pages[0].split(';')[0]
         page_link = page_link.strip('>').strip('<')
         page_link = page_link.split('=')
         page_num = int(page_link[-1])
-        for page in range(0, page_num):
-            git_page_number = page + 1
+
+        def get_page(git_page_number):
             req_path = git_path % (api_uri, git_page_number)
-            response, content = HTTP.request(req_path, 'GET', headers=headers)
-            for repo in json.loads(content):
-                repo_content.append(repo)
-        else:
-            return repo_content
+            response, content = http_request(req_path, 'GET', headers=headers)
+            return json.loads(content)
+
+        repo_content = []
+        for page in run_pool(get_page, range(1, page_num + 1)):
+            repo_content.extend(page)
+        return repo_content
     else:
-        response, content = HTTP.request(path, 'GET', headers=headers)
+        response, content = http_request(path, 'GET', headers=headers)
         return json.loads(content)
 
 
 def process_repos(repo_content, headers, irc_config_data, configured_events):
-    """Iterate through the repos and ensure the IRC triggers are setup.
+    """Ensure the IRC triggers are setup on every repo.
+
+    The hooks of all repos are fetched in parallel, then the changes they
+    need are applied as one batch.
 
     :param repo_content: ``list``
     :param headers: ``dict``
     :param irc_config_data: ``dict``
     :param configured_events: ``dict``
+    :return: ``dict``
     """
-    for repo in repo_content:
-        # Update all of the IRC data with our configured events
-        irc_config_data.update(configured_events)
+    # Update all of the IRC data with our configured events
+    irc_config_data.update(configured_events)
 
+    def get_hooks(repo):
         LOG.info('Fetching hooks for repo: %s' % repo['name'])
         hook_path = '%s/hooks' % repo['url']
-        response, content = HTTP.request(hook_path, 'GET', headers=headers)
+        response, content = http_request(hook_path, 'GET', headers=headers)
+        if response.status != 200:
+            LOG.error(
+                'FAILED TO FETCH HOOKS FOR [ %s ] RETURN CODE [ %s ]',
+                repo['name'], response.status
+            )
+            return None
 
-        process_hooks(
+        return plan_hooks(
             hook_list=json.loads(content),
             irc_data=irc_config_data,
             git_hook_path=hook_path,
-            git_headers=headers,
             git_event_data=configured_events,
             git_repo=repo
         )
 
+    summary = {'created': 0, 'updated': 0, 'unchanged': 0, 'failed': 0}
+    changes = []
+    for repo_changes in run_pool(get_hooks, repo_content):
+        if repo_changes is None:
+            summary['failed'] += 1
+        elif repo_changes:
+            changes.extend(repo_changes)
+        else:
+            summary['unchanged'] += 1
+
+    LOG.info('Applying [ %s ] hook changes', len(changes))
+    applied = run_pool(lambda change: apply_change(change, headers), changes)
+    for change, success in zip(changes, applied):
+        if success:
+            summary[change['action']] += 1
+        else:
+            summary['failed'] += 1
+
+    return summary
+
 
 def main():
     """Run the main application."""
     # Get all of the configuration options from our configuration file.
     irc_args, git_repos = get_config()
 
+    totals = {}
+
     # Iterate through the repos and make sure the IRC notifier is working
     for git_repo in git_repos.keys():
         username, password, api_uri = git_repos[git_repo].split('||')
@@ -425,17 +595,41 @@ def main():
         configured_events = {
             'events': irc_args.get('events', '').split(',')
         }
-        process_repos(
+        summary = process_repos(
             repo_content=repo_content,
             headers=headers,
             irc_config_data=irc_config_data,
             configured_events=configured_events
         )
+        LOG.info(
+            'IRC hooks for %s: created [ %s ] updated [ %s ] unchanged [ %s ]'
+            ' failed [ %s ]', api_uri, summary['created'], summary['updated'],
+            summary['unchanged'], summary['failed']
+        )
+        for key, value in summary.items():
+            totals[key] = totals.get(key, 0) + value
+
+    LOG.info(
+        'IRC hooks in total: created [ %s ] updated [ %s ] unchanged [ %s ]'
+        ' failed [ %s ]', totals.get('created', 0), totals.get('updated', 0),
+        totals.get('unchanged', 0), totals.get('failed', 0)
+    )
+    LOG.info(
+        'Github responses served from cache [ %s ] fetched [ %s ]',
+        CACHE_STATS['hits'], CACHE_STATS['misses']
+    )
 
 
 APPNAME = 'jenkins_notify'
 HOME = os.getenv('HOME')
-HTTP = httplib2.Http()
+WORKERS = 10
+BUCKET = TokenBucket(rate=10, capacity=WORKERS)
+LOCAL = threading.local()
+STATS_LOCK = threading.Lock()
+CACHE_STATS = {'hits': 0, 'misses': 0}
+# Files httplib2 writes to the cache are only readable by this user too
+os.umask(0o077)
+CACHE_DIR = private_cache_dir(os.path.join(HOME, '.%s.cache' % APPNAME))
 
 if len(sys.argv) > 1 and sys.argv[1] == '--debug':
     DEBUG = True
@@ -17,19 +17,41 @@ parser = ConfigParser.ConfigParser()
 parser.readfp(config)
 username, password = parser.get('default', 'user').split(':')
 
-# httplib2.debuglevel = 4
-http = httplib2.Http()
 auth = base64.encodestring("%s:%s" % (username, password))
 headers = {
   'Authorization': 'Basic ' + auth
 }
 
+# Keep github responses between runs, httplib2 revalidates them and a 304
+# does not count against the rate limit. The hooks hold credentials, so the
+# cache and everything in it is only readable by this user.
+os.umask(0077)
+cache_dir = os.path.join(os.getenv("HOME"), ".rcbjenkins-git-cache")
+if not os.path.isdir(cache_dir):
+    os.makedirs(cache_dir, 0700)
+os.chmod(cache_dir, 0700)
+cache_hits = 0
+
+# httplib2.debuglevel = 4
+http = httplib2.Http(cache_dir)
+
+
+def cached_request(path):
+    """
+    GETs path through the cache, counting the responses it served
+    """
+    global cache_hits
+    response, content = http.request(path, 'GET', headers=headers)
+    if response.fromcache:
+        cache_hits += 1
+    return response, content
+
 print "Grabbing all repos from https://github.com/rcbops-cookbooks"
 
 # github paginates, this will be an issue once we have ~100 repos
 path = "https://api.github.com/orgs/rcbops-cookbooks/repos?per_page=100"
 
-response, content = http.request(path, 'GET', headers=headers)
+response, content = cached_request(path)
 
 push_hook_url = "http://build.monkeypuppetlabs.com/gitpost/posthook/"
 push_data = {"events": [ "push" ]}
@@ -57,7 +79,7 @@ repo_list = json.loads(content)
 for repo in repo_list:
     print "Fetching hooks for repo: %s" % repo['name']
     hook_path = "%s/hooks" % repo['url']
-    response, content = http.request(hook_path, 'GET', headers=headers)
+    response, content = cached_request(hook_path)
 
     hook_list = json.loads(content)
     #pprint(hook_list)
@@ -103,4 +125,6 @@ for repo in repo_list:
             print ".... FAILED TO ADD PULL_REQUEST HOOK FOR %s" % (repo['name'])
             sys.exit(1)
 
+print "%d of %d github responses served from cache" % (cache_hits,
+                                                      len(repo_list) + 1)
 sys.exit(0)
@@ -1,6 +1,8 @@
 """Gathers application config"""
 
 import os
+import hashlib
+import cPickle as pickle
 import logging
 from yaml import load
 
@@ -12,8 +14,57 @@ class Config(object):
             file = os.path.join(os.path.dirname(__file__),
                                 os.pardir,
                                 'config.yaml')
-        f = open(file)
-        self.config = load(f)
+        self.config = self.load(file)
+
+    @staticmethod
+    def load(file):
+        """
+        Parses file, reusing a pickle of the last parse while the file's
+        mtime is unchanged
+        """
+        mtime = os.path.getmtime(file)
+        cache_dir = Config.cache_dir()
+        if cache_dir is None:
+            with open(file) as f:
+                return load(f)
+        cache = os.path.join(cache_dir, "%s.pickle" %
+                             hashlib.md5(os.path.abspath(file)).hexdigest())
+        try:
+            with open(cache, 'rb') as f:
+                cached_mtime, config = pickle.load(f)
+            if cached_mtime == mtime:
+                return config
+        except Exception:
+            # Missing or unreadable cache, parse the yaml instead
+            pass
+        with open(file) as f:
+            config = load(f)
+        try:
+            tmp_file = "%s.%s" % (cache, os.getpid())
+            with open(tmp_file, 'wb') as f:
+                pickle.dump((mtime, config), f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_file, cache)
+        except (IOError, OSError):
+            pass
+        return config
+
+    @staticmethod
+    def cache_dir():
+        """
+        The user's own config cache dir, a pickle is only ever loaded from a
+        dir nobody else can write to
+        @return path or None when there is no safe dir
+        """
+        path = os.path.join(os.path.expanduser("~"), ".cache", "qa-config")
+        try:
+            if not os.path.isdir(path):
+                os.makedirs(path, 0700)
+            st = os.lstat(path)
+        except OSError:
+            return None
+        if st.st_uid != os.getuid() or st.st_mode & 0077:
+            return None
+        return path
 
     def __getitem__(self, name):
         return self.config[name]
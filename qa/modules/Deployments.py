@@ -1,13 +1,17 @@
 import os
 import types
+import random
 import logging
 from time import sleep
 from chef import autoconfigure, Search
+from chef import Node as CNode
 from Config import Config
 from inspect import getmembers, isclass
 from razor_api import razor_api
 from Environments import Chef
 from Nodes import ChefRazorNode
+from server_helper import run_parallel
+from lease_helper import lease_helper
 import features.Deployment as deployment_features
 
 """
@@ -43,10 +47,25 @@ class Deployment(object):
 
         return "\n".join([outl, features, nodes])
 
+    def destroy_node(self, node):
+        """Destroys a single node"""
+        return node.destroy()
+
     def destroy(self):
-        """ Destroys an OpenStack deployment """
-        for node in self.nodes:
-            node.destroy()
+        """
+        Destroys an OpenStack deployment's nodes in parallel
+        Returns a dict of node name to the error destroying it, which is
+        None for every node, and raises with that report otherwise
+        """
+        report = {}
+        for node, ret, error in run_parallel(self.destroy_node, self.nodes):
+            if error is not None:
+                logging.error("Failed to destroy {0}: {1}".format(
+                    node.name, error))
+            report[node.name] = error
+        if any(error is not None for error in report.values()):
+            raise Exception("Failed to destroy nodes: {0}".format(report))
+        return report
 
     def create_node(self, role):
         """ Abstract node creation method """
@@ -65,10 +84,43 @@ class Deployment(object):
         for feature in self.features:
             feature.pre_configure()
 
+    def build_order(self):
+        """
+        Groups nodes into waves where every node only depends on nodes
+        in earlier waves. Nodes that declare no dependencies, i.e. cinder,
+        keep their place in the serial order and wait for every node listed
+        before them. Within a wave nodes stay in the order of self.nodes.
+        """
+        deps = {}
+        for index, node in enumerate(self.nodes):
+            deps[node] = (node.dependencies(self.nodes) or
+                          self.nodes[:index])
+        built = []
+        waves = []
+        remaining = list(self.nodes)
+        while remaining:
+            wave = [node for node in remaining
+                    if all(dep in built for dep in deps[node])]
+            if not wave:
+                raise Exception("Circular node dependencies: {0}".format(
+                    ", ".join(node.name for node in remaining)))
+            waves.append(wave)
+            built.extend(wave)
+            remaining = [node for node in remaining if node not in wave]
+        return waves
+
+    def build_node(self, node):
+        """Builds a single node"""
+        node.build()
+
     def build_nodes(self):
-        """Builds each node"""
-        for node in self.nodes:
-            node.build()
+        """Builds each wave of independent nodes in parallel"""
+        for wave in self.build_order():
+            logging.info("Building: {0}".format(
+                ", ".join(node.name for node in wave)))
+            for node, ret, error in run_parallel(self.build_node, wave):
+                if error is not None:
+                    raise error
 
     def post_configure(self):
         """Post configures node for each feature"""
@@ -103,20 +155,33 @@ class ChefRazorDeployment(Deployment):
                                                   config)
         self.environment = environment
         self.razor = razor
+        self.leases = lease_helper(environment.local_api)
 
     def free_node(self, image, environment):
         """
         Provides a free node from
         """
         nodes = self.node_search("name:qa-%s-pool*" % image)
-        for node in nodes:
-            is_default = node.chef_environment == "_default"
-            iface_in_run_list = "recipe[network-interfaces]" in node.run_list
-            if (is_default and iface_in_run_list):
-                node.chef_environment = environment.name
-                node['in_use'] = "provisioned"
-                node.save()
-                return node
+        free = [node.name for node in nodes
+                if node.chef_environment == "_default" and
+                "recipe[network-interfaces]" in node.run_list]
+        # Lease the node while moving it so concurrent deployments never
+        # take the same one
+        while free:
+            names = self.leases.claim(free)
+            if not names:
+                break
+            free = [name for name in free if name not in names]
+            try:
+                # The search index lags, make sure nobody beat us to it
+                node = CNode(names[0], api=environment.local_api)
+                if node.chef_environment == "_default":
+                    node.chef_environment = environment.name
+                    node['in_use'] = "provisioned"
+                    node.save()
+                    return node
+            finally:
+                self.leases.release(names)
         raise Exception("No more nodes!!")
         self.destroy()
 
@@ -171,21 +236,61 @@ class ChefRazorDeployment(Deployment):
         for feature, rpcs_feature in features.items():
             self.features.append(classes[feature](self, rpcs_feature[0]))
 
-    def node_search(cls, query, environment=None, tries=10):
+    def node_search(cls, query, environment=None, tries=10, backoff=1):
+        """
+        Searches chef for nodes, only retrying with exponential backoff
+        and jitter while the search comes back empty
+        """
         api = autoconfigure()
         if environment:
             api = environment.local_api
-        search = None
-        while not search and tries > 0:
+        delay = backoff
+        search = []
+        for attempt in xrange(tries):
             search = Search("node", api=api).query(query)
-            sleep(10)
-            tries = tries - 1
+            if search or attempt == tries - 1:
+                break
+            sleep(delay + random.uniform(0, delay))
+            delay = min(delay * 2, 30)
         return (n.object for n in search)
 
+    def wait_for_indexed(self, name, attribute=None, value=None,
+                         environment=None, tries=10):
+        """
+        Waits until a node, and optionally one of its attributes, is
+        visible to search, i.e. right after saving it
+        """
+        query = "name:{0}".format(name)
+        if attribute:
+            query = "{0} AND {1}:{2}".format(query, attribute, value)
+        return next(self.node_search(query, environment, tries), None)
+
+    def build_node(self, node):
+        """
+        Builds a single node against the deployments chef server. pychef
+        keeps its api stack per thread, so the api is entered here in the
+        worker thread, anything node.build hands to another thread has to
+        pass the api explicitly
+        """
+        with self.environment.local_api:
+            node.build()
+
     def search_role(self, feature):
         """Returns nodes the have the desired role"""
         return (node for node in self.nodes if feature in node.features)
 
+    def update_environment(self):
+        """Updates the environment for each feature, saving it once"""
+        with self.environment.batch():
+            super(ChefRazorDeployment, self).update_environment()
+
+    def destroy_node(self, node):
+        """Destroys a single node against the deployments chef server"""
+        with self.environment.local_api:
+            return node.destroy()
+
     def destroy(self):
-        super(ChefRazorDeployment, self).destroy()
+        # Raises before the environment goes while nodes still point at it
+        report = super(ChefRazorDeployment, self).destroy()
         self.environment.destroy()
+        return report
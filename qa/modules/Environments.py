@@ -2,6 +2,8 @@
 OpenStack Environments
 """
 
+from copy import deepcopy
+from contextlib import contextmanager
 from modules import util
 from chef import Environment as ChefEnvironment
 
@@ -23,16 +25,18 @@ class Environment(dict):
 class Chef(Environment):
 
     def __init__(self, name, local_api, chef_server_name=None, remote_api=None,
-                 description=None, default={}, override={}):
+                 description=None, default=None, override=None):
         super(Chef, self).__init__(name, description)
         self.cookbook_versions = {}
         self.json_class = "Chef::Environment"
         self.chef_type = "environment"
-        self.default_attributes = default
-        self.override_attributes = override
+        self.default_attributes = default or {}
+        self.override_attributes = override or {}
         self.local_api = local_api
         self.remote_api = remote_api
         self.chef_server_name = chef_server_name
+        self.batches = 0
+        self.saved = {}
         self.save()
 
     def add_override_attr(self, key, value):
@@ -51,12 +55,42 @@ class Chef(Environment):
         del self.default_attributes[key]
         self.save()
 
+    @contextmanager
+    def batch(self):
+        """
+        Holds back saves made inside the block, then saves once at the end
+        """
+        self.batches += 1
+        try:
+            yield self
+        finally:
+            self.batches -= 1
+        self.save()
+
+    def to_dict(self):
+        return {'description': self.description or "",
+                'cookbook_versions': self.cookbook_versions,
+                'default_attributes': self.default_attributes,
+                'override_attributes': self.override_attributes}
+
     def save(self):
-        env = ChefEnvironment(self.name, api=self.local_api)
-        env.attributes = self.__dict__
-        env.save(self.local_api)
-        if self.remote_api:
-            env.save(self.remote_api)
+        """
+        Saves to each chef server, unless batched or nothing has changed
+        since the last save to it
+        """
+        if self.batches:
+            return
+        state = deepcopy(self.to_dict())
+        for api in (self.local_api, self.remote_api):
+            if not api or self.saved.get(api) == state:
+                continue
+            # A save creates the environment when it is missing, so don't
+            # fetch it first
+            env = ChefEnvironment(self.name, api=api, skip_load=True)
+            for attr, value in state.items():
+                setattr(env, attr, value)
+            env.save(api)
+            self.saved[api] = state
 
     def destroy(self):
         ChefEnvironment(self.name).delete()
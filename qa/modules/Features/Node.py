@@ -12,6 +12,9 @@ class Node(Feature):
     """ Represents a feature on a node
     """
 
+    # Features on other nodes that have to be built before this one
+    requires = []
+
     def __init__(self, node):
         super(Node, self).__init__(node.deployment.config)
         self.node = node
@@ -34,6 +37,8 @@ class Controller(Node):
     """ Represents a RPCS Controller
     """
 
+    requires = ['chefserver']
+
     def __init__(self, node):
         super(Controller, self).__init__(node)
 
@@ -54,6 +59,8 @@ class Compute(Node):
     """ Represents a RPCS compute
     """
 
+    requires = ['chefserver', 'controller']
+
     def __init__(self, node):
         super(Compute, self).__init__(node)
 
@@ -71,6 +78,8 @@ class Proxy(Node):
     """ Represents a RPCS proxy node
     """
 
+    requires = ['chefserver', 'controller']
+
     def __init__(self, node):
         super(Proxy, self).__init__(node)
 
@@ -196,6 +205,8 @@ class Remote(Node):
     """ Represents the deployment having a remote chef server
     """
 
+    requires = ['chefserver']
+
     def __init__(self, node):
         super(Remote, self).__init__(node)
 
@@ -274,6 +285,8 @@ class Swift(Node):
     """ Represents a RPCS object store node
     """
 
+    requires = ['chefserver', 'controller']
+
     def __init__(self, node):
         super(Swift, self).__init__(node)
 
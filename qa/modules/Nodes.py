@@ -1,11 +1,11 @@
 import types
 import logging
-from time import sleep
+from time import time
 from chef import Node as CNode
 from chef import Client as CClient
 import features.Node as node_features
 from inspect import getmembers, isclass
-from server_helper import ssh_cmd, scp_to, scp_from
+from server_helper import ssh_cmd, scp_to, scp_from, pool
 
 
 class Node(object):
@@ -23,6 +23,7 @@ class Node(object):
         self.environment = environment
         self.deployment = deployment
         self.features = []
+        self.requires = []
         self._cleanups = []
 
     def __repr__(self):
@@ -63,6 +64,28 @@ class Node(object):
         return scp_from(self.ip, remote_path, user=user, password=password,
                         local_path=local_path)
 
+    def add_dependency(self, node):
+        """Marks node as having to be built before this one"""
+        if node not in self.requires:
+            self.requires.append(node)
+
+    def dependencies(self, nodes):
+        """
+        Returns the nodes out of nodes that have to be built before this one,
+        either added explicitly or providing a feature one of ours requires
+        """
+        wanted = set(name for feature in self.features
+                     for name in getattr(feature, 'requires', []))
+        deps = list(self.requires)
+        for node in nodes:
+            if node is self or node in deps:
+                continue
+            provided = set(feature.__class__.__name__.lower()
+                           for feature in node.features)
+            if provided & wanted:
+                deps.append(node)
+        return deps
+
     def update_environment(self):
         """Updates environment for each feature"""
         for feature in self.features:
@@ -109,6 +132,10 @@ class ChefRazorNode(Node):
     A chef entity
     Provides chef related server fuctions
     """
+
+    # Seconds a fetched chef node is trusted before fetching it again
+    cache_ttl = 30
+
     def __init__(self, name, os, product, environment, deployment, provisioner,
                  branch):
         self.name = name
@@ -120,6 +147,7 @@ class ChefRazorNode(Node):
         self.razor = provisioner
         self.branch = branch
         self.features = []
+        self.requires = []
         self._cleanups = []
 
     def __str__(self):
@@ -136,6 +164,8 @@ class ChefRazorNode(Node):
     def apply_feature(self):
         if self.run_list:
             self.run_cmd("chef-client")
+            # chef-client rewrites the nodes attributes
+            self.invalidate()
         super(ChefRazorNode, self).apply_feature()
 
     def _password(self):
@@ -149,13 +179,31 @@ class ChefRazorNode(Node):
         """
         Gets ip, user, and password from chef
         """
-        map = {'ip': self['ipaddress'],
-               'user': self['current_user'],
-               'password': self._password()}
-        if item in map.keys():
-            return map[item]
-        else:
-            return self.__dict__[item]
+        if item == 'ip':
+            return self['ipaddress']
+        if item == 'user':
+            return self['current_user']
+        if item == 'password':
+            return self._password()
+        raise AttributeError(item)
+
+    def _chef_node(self):
+        """
+        Returns the local chef node, fetching it again once the cached copy
+        is older than cache_ttl
+        """
+        # Go through __dict__ so a cache miss never lands in __getattr__
+        cached = self.__dict__.get('_cnode')
+        if cached is None or time() - cached[1] > self.cache_ttl:
+            cached = (CNode(self.name, api=self.environment.local_api), time())
+            self.__dict__['_cnode'] = cached
+        return cached[0]
+
+    def invalidate(self):
+        """
+        Drops the cached chef node so the next lookup hits the chef server
+        """
+        self.__dict__.pop('_cnode', None)
 
     def add_run_list_item(self, items):
         self.run_list.extend(items)
@@ -165,12 +213,13 @@ class ChefRazorNode(Node):
         """
         Node has access to chef attributes
         """
-        return CNode(self.name, api=self.environment.local_api)[item]
+        return self._chef_node()[item]
 
     def __setitem__(self, item, value):
         """
         Node can set chef attributes
         """
+        self.invalidate()
         lnode = CNode(self.name, api=self.environment.local_api)
         lnode[item] = value
         lnode.save()
@@ -180,19 +229,25 @@ class ChefRazorNode(Node):
             rnode.save()
 
     def destroy(self):
+        """
+        Returns a clean node to the pool or rekicks a dirty one
+        Returns True if the node was rekicked
+        """
         cnode = CNode(self.name)
+        self.invalidate()
         if self['in_use'] == "provisioned":
             # Return to pool if the node is clean
             cnode.chef_environment = "_default"
             cnode.save()
-        else:
-            # Remove active model if the node is dirty
-            active_model = cnode['razor_metadata']['razor_active_model_uuid']
-            self.razor.remove_active_model(active_model)
-            self.run_cmd("reboot 0")
-            CClient(self.name).delete()
-            cnode.delete()
-            sleep(15)
+            return False
+        # Remove active model if the node is dirty
+        active_model = cnode['razor_metadata']['razor_active_model_uuid']
+        self.razor.remove_active_model(active_model)
+        self.run_cmd("reboot 0")
+        pool.discard(self.ip, self.user)
+        CClient(self.name).delete()
+        cnode.delete()
+        return True
 
     def add_features(self, features):
         classes = {k.lower(): v for (k, v) in
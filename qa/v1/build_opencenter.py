@@ -230,7 +230,7 @@ if results.action == "build":
         print "Chef Server (VM) with IP: %s on Host: %s" % (chef_server_ip, controller)
         print "Controller Node: %s with IP: %s" % (controller, controller_ip)
         for agent in computes:
-            node = Node(agent)
+            node = Node(agent, api=rpcsqa.chef)
             print "Agent Node: %s with IP: %s" % (agent, node['ipaddress'])
         print "************************************************************"
 
@@ -5,6 +5,7 @@ import argparse
 from chef import *
 from razor_api import razor_api
 from ssh_session import ssh_session
+from modules.server_helper import sftp_put
 from subprocess import check_call, CalledProcessError
 
 # Parse arguments from the cmd line
@@ -137,14 +138,13 @@ if active_models:
             print fo.read()
             
         # SCP the env.sh to the opencenter server
-        try:
-            print "!!## -- Transfering the environment file to the server: %s -- ##!!" % opencenter_server_ip
-            check_call_return = check_call("sshpass -p %s scp -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no -o LogLevel=quiet %s root@%s:/root/env.sh" % (opencenter_server_password, env_file, opencenter_server_ip), shell=True)
-        except CalledProcessError, cpe:
+        print "!!## -- Transfering the environment file to the server: %s -- ##!!" % opencenter_server_ip
+        transfer = sftp_put(opencenter_server_ip, env_file,
+                            password=opencenter_server_password,
+                            remote_path="/root/env.sh")
+        if not transfer['success']:
             print "!!## -- Failed to transfer environment file  -- ##!!"
-            print "!!## -- Return Code: %s  -- ##!!" % cpe.returncode
-            #print "!!## -- Command: %s -- ##!!" % cpe.cmd
-            print "!!## -- Output: %s -- ##!!" % cpe.output
+            print "!!## -- Error: %s -- ##!!" % transfer['exception']
             
         
         # Delete env.sh from current file system
@@ -5,6 +5,7 @@ import time
 import argparse
 from chef import *
 from razor_api import razor_api
+from modules.server_helper import sftp_put
 from subprocess import check_call, CalledProcessError
 
 # Parse the cmd line arguments
@@ -82,19 +83,19 @@ if active_models:
      if not display_only:
           for server in to_run_list:
                print "!!## -- Trying to import ldif on %s with ip %s...." % (server['node'], server['ip'])
-               try:
-                    print "!!## -- Trying to scp ldif files  -- ##!!"
-                    check_call_return = subprocess.check_call("sshpass -p %s scp -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no -o LogLevel=quiet  /var/lib/jenkins/source_files/ldif/*.ldif root@%s:/root" % (server['root_password'], server['ip']), shell=True)
-                except CalledProcessError, cpe:
+               print "!!## -- Trying to scp ldif files  -- ##!!"
+               transfer = sftp_put(server['ip'],
+                                   '/var/lib/jenkins/source_files/ldif/*.ldif',
+                                   password=server['root_password'],
+                                   remote_path='/root')
+               if not transfer['success']:
                     print "!!## -- Failed to copy ldif files  -- ##!!"
-                    print "!!## -- Return Code: %s  -- ##!!" % cpe.returncode
-                    #print "!!## -- Command: %s -- ##!!" % cpe.cmd
-                    print "!!## -- Output: %s -- ##!!" % cpe.output
-                
-                try:
+                    print "!!## -- Error: %s  -- ##!!" % transfer['exception']
+
+               try:
                     print "!!## -- Trying to import ldif files on ldap server  -- ##!!"
-                    check_call_return = subprocess.check_call("sshpass -p %s ssh -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no -o LogLevel=quiet -l root %s 'ldapadd -x -D \"cn=admin,dc=dev,dc=rcbops,dc=me\" -f base.ldif -w@privatecloud'" % (server['root_password'], server['ip']), shell=True)
-                except CalledProcessError, cpe:
+                    check_call_return = check_call("sshpass -p %s ssh -o UserKnownHostsFile=/dev/null -o StrictHostKeyChecking=no -o LogLevel=quiet -l root %s 'ldapadd -x -D \"cn=admin,dc=dev,dc=rcbops,dc=me\" -f base.ldif -w@privatecloud'" % (server['root_password'], server['ip']), shell=True)
+               except CalledProcessError, cpe:
                     print "!!## -- Failed to import ldif files on ldap server -- ##!!"
                     print "!!## -- Return Code: %s..." % cpe.returncode
                     #print "!!## -- Command: %s" % cpe.cmd
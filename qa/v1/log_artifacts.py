@@ -1,8 +1,14 @@
+import os
 import sys
+import json
+import time
+import zlib
+import tarfile
 import argparse
 from pprint import pprint
+from cStringIO import StringIO
 from modules.rpcsqa_helper import rpcsqa_helper
-from modules.server_helper import run_cmd
+from modules.server_helper import run_cmd, sftp_session
 
 # Parse arguments from the cmd line
 parser = argparse.ArgumentParser()
@@ -21,6 +27,22 @@ parser.add_argument('--feature_set', action="store", dest="feature_set",
 parser.add_argument('--os_distro', action="store", dest="os_distro",
                     required=False, default='precise',
                     help="Operating System Distribution to build OpenStack on")
+
+parser.add_argument('--max_size', action="store", dest="max_size", type=int,
+                    required=False, default=512,
+                    help="Most MB of logs to collect from each node")
+
+parser.add_argument('--timeout', action="store", dest="timeout", type=int,
+                    required=False, default=600,
+                    help="Most seconds to spend collecting from each node")
+
+parser.add_argument('--incremental', action="store_true",
+                    dest="incremental", required=False, default=False,
+                    help="Only ship what changed since the last collection")
+
+parser.add_argument('--log_dir', action="store", dest="log_dir",
+                    required=False, default="logs",
+                    help="Where incremental collections are kept")
 results = parser.parse_args()
 
 # Get nodes
@@ -69,9 +91,10 @@ misc_cmds = [["networking", ["iptables-save", "ip a", "netstat -nt",
 
 # Run commands to acquire artifacts
 roles = {}
-log_path = "logs"
-# run_cmd("rm -rf %s; mkdir -p %s" % (log_path, log_path))
-run_cmd("rm *.tar.gz")
+if not results.incremental:
+    run_cmd("rm -f *.tar.gz *.manifest.json")
+archive_paths = " ".join(path + f for x, path in archive for f in x)
+collections = []
 for node in nodes:
     # Added in case in_use gets set funny
     role = str(node.attributes['in_use'])
@@ -81,37 +104,280 @@ for node in nodes:
         roles[role] = 1
     node_name = "%s%s" % (role, roles[role])
 
-    prepare_cmd = "; ".join("rm -rf {0}/{1}; mkdir -p {0}/{1}".format(node_name, path)
-                            for path in (var_path, etc_path, misc_path))
-
-    cp_format = "[ -e /{1}{0} ] && cp -r /{1}{0} %s/{1}{0}" % node_name
-    archive_cmd = '; '.join(cp_format.format(f, path)
-                            for x, path in archive
-                            for f in x)
-
-    # Misc commands
-    misc_format = "%s >> %s/%s%s.txt"
-    format_misc = lambda x: "; ".join(misc_format % (cmd, node_name,
-                                                     misc_path, x[0])
+    # Misc commands, their output is all that gets staged on the node
+    misc_format = "%s >> $misc/%s%s.txt"
+    format_misc = lambda x: "; ".join(misc_format % (cmd, misc_path, x[0])
                                       for cmd in x[1])
     misc_cmd = "; ".join(map(format_misc, misc_cmds))
 
     chef_cmd = "echo 'Not a Chef Server'"
     if 'chef' in role:
         chef_cmd = ('for i in `knife node list`;'
-                    'do knife node show $i -l >> {0}/{1}/$i.knife;'
-                    'done'.format(node_name, misc_path))
+                    'do knife node show $i -l >> $misc/{0}$i.knife;'
+                    'done'.format(misc_path))
+
+    # Only ask tar for what exists so a missing service isn't an error
+    find_cmd = ('paths=$(cd / && for p in %s; do [ -e "$p" ] && echo "$p"; '
+                'done)' % archive_paths)
 
-    tar_cmd = "tar -czf %s.tar.gz %s" % (node_name, node_name)
+    # Logs are tarred from where they live and streamed back over ssh
+    tar_cmd = ('tar -czf - --ignore-failed-read --transform "s,^,{0}/,S" '
+               '-C / $paths -C $misc {1}'.format(node_name, misc_path))
+
+    stage_cmd = "{ %s; %s; } > /dev/null" % (chef_cmd, misc_cmd)
 
     # Run all the commands at once.  SSH takes eternities
-    cmd = '; '.join((prepare_cmd, archive_cmd, chef_cmd,
-                     misc_cmd,
-                     tar_cmd))
+    cmd = '; '.join(("misc=$(mktemp -d)",
+                     "mkdir -p $misc/%s" % misc_path,
+                     stage_cmd,
+                     find_cmd,
+                     tar_cmd,
+                     "status=$?",
+                     "rm -rf $misc",
+                     "exit $status"))
+
+    collections.append((node, node_name, cmd, stage_cmd))
+
+
+def write_manifest(node, node_name, archive_file, run):
+    files = []
+    try:
+        with tarfile.open(archive_file) as tar:
+            for member in tar:
+                if member.isfile():
+                    files.append({'name': member.name, 'size': member.size})
+    except (tarfile.TarError, IOError, EOFError, zlib.error):
+        # The stream was cut short, keep what could be listed
+        pass
+    manifest = {'node': node.name,
+                'ip': node['ipaddress'],
+                'archive': archive_file,
+                'bytes': run['return'],
+                'seconds': round(run['seconds'], 2),
+                'exit_status': run['exit_status'],
+                'truncated': run['truncated'],
+                'error': run['error'],
+                'files': files}
+    with open("%s.manifest.json" % node_name, "w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+# Incremental collections stage misc output in a fixed place on the node
+misc_stage = "var/tmp/qa-artifacts/"
+# Bytes hashed at the head of each file to tell appends from rewrites
+head_bytes = 65536
+
+
+def manifest_cmd(stage_cmd):
+    """
+    Stages the misc output then lists every file to collect as
+    "size mtime device inode head-md5 path"
+    """
+    return '; '.join((
+        "misc=/%s" % misc_stage,
+        "rm -rf $misc",
+        "mkdir -p $misc/%s" % misc_path,
+        stage_cmd,
+        'cd / && for p in %s %s; do [ -e "$p" ] && find "$p" -type f; done '
+        '| while read f; do echo "$(stat -c \'%%s %%Y %%d %%i\' "$f") '
+        '$(head -c %s "$f" | md5sum | cut -d\' \' -f1) $f"; done'
+        % (archive_paths, misc_stage, head_bytes)))
+
+
+def parse_manifest(output):
+    manifest = {}
+    for line in output.splitlines():
+        try:
+            size, mtime, dev, inode, md5, path = line.strip().split(' ', 5)
+            manifest[path] = {'size': int(size), 'mtime': int(mtime),
+                              'dev': int(dev), 'inode': int(inode),
+                              'hash': md5}
+        except ValueError:
+            # Not a manifest line, i.e. noise from a staging command
+            continue
+    return manifest
+
 
-    qa.run_cmd_on_node(node, cmd)
+def local_name(path):
+    if path.startswith(misc_stage):
+        return path[len(misc_stage):]
+    return path
 
-    qa.scp_from_node(node, path="%s.tar.gz" % node_name, destination=".")
+
+def file_id(entry):
+    # Inodes are only unique within a device
+    return (entry.get('dev'), entry['inode'])
+
+
+def appended(old, new):
+    """
+    A file only grew if it was already past the hashed head, which is still
+    the same, and it got no shorter
+    """
+    return (old['size'] >= head_bytes and new['size'] >= old['size'] and
+            new['hash'] == old['hash'])
+
+
+def plan_transfers(previous, current, node_dir):
+    """
+    Diffs two remote manifests into the byte ranges still to be shipped,
+    recording in each current entry the local file it is shipped into
+    @return list of (remote path, local path, offset, length, append)
+    """
+    def held(entry, path):
+        # The local file an entry was shipped into, if it is still there
+        local = entry.get('local', local_name(path))
+        if os.path.exists(os.path.join(node_dir, local)):
+            return local
+        return None
+
+    inodes = dict((file_id(entry), path) for path, entry in previous.items())
+    rotated = []
+    changed = []
+    for path, entry in sorted(current.items()):
+        entry['local'] = local_name(path)
+        old = previous.get(path)
+        if path.startswith(misc_stage):
+            # Regenerated on every run
+            changed.append((path, entry['local'], 0, entry['size'], False))
+            continue
+        if old is not None and held(old, path) is None:
+            old = None
+        if old is not None and file_id(old) == file_id(entry):
+            entry['local'] = held(old, path)
+            if entry['size'] == old['size'] and entry['mtime'] == old['mtime']:
+                continue
+            if appended(old, entry):
+                changed.append((path, entry['local'], old['size'],
+                                entry['size'] - old['size'], True))
+            else:
+                changed.append((path, entry['local'], 0, entry['size'],
+                                False))
+            continue
+        moved = inodes.get(file_id(entry))
+        if moved is not None and moved != path and \
+                held(previous[moved], moved) is not None:
+            # Rotated away from moved, which we already hold the head of,
+            # so only what was written before rotation is new
+            before = previous[moved]
+            entry['local'] = held(before, moved)
+            if appended(before, entry):
+                if entry['size'] > before['size']:
+                    rotated.append((path, entry['local'], before['size'],
+                                    entry['size'] - before['size'], True))
+            else:
+                rotated.append((path, entry['local'], 0, entry['size'],
+                                False))
+            continue
+        # A new file where the old one was rotated away is tail appended so
+        # the local copy reads as one continuous log
+        if old is not None:
+            entry['local'] = held(old, path)
+        changed.append((path, entry['local'], 0, entry['size'],
+                        old is not None))
+    # Finish the rotated files off before their replacements append to them
+    return rotated + changed
+
+
+def ship(sftp, node_dir, transfers, chunk=1048576):
+    """
+    Copies each planned byte range down from the node
+    @return bytes shipped and the remote paths that failed to ship
+    """
+    size = 0
+    failed = []
+    for remote, local, offset, length, append in transfers:
+        target = os.path.join(node_dir, local)
+        if not os.path.isdir(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+        ranges = [(start, min(chunk, offset + length - start))
+                  for start in xrange(offset, offset + length, chunk)]
+        try:
+            with sftp.open('/' + remote) as rf:
+                with open(target, 'ab' if append else 'wb') as lf:
+                    for data in rf.readv(ranges):
+                        lf.write(data)
+                        size += len(data)
+        except IOError, e:
+            # i.e. rotated away or deleted since the manifest was taken
+            print "Failed to ship %s: %s" % (remote, e)
+            failed.append(remote)
+    return size, failed
+
+
+def collect_incremental(collection):
+    node, node_name, cmd, stage_cmd = collection
+    start = time.time()
+    node_dir = os.path.join(results.log_dir, node.name)
+    state_file = "%s.manifest.json" % node_dir
+    try:
+        with open(state_file) as f:
+            previous = json.load(f)
+    except (IOError, ValueError):
+        previous = {}
+
+    ip = node['ipaddress']
+    password = qa.razor_password(node)
+    # A cut short manifest would drop files from the saved state, so take
+    # all of it or nothing
+    output = StringIO()
+    run = qa.stream_cmd_on_node(node, manifest_cmd(stage_cmd), output,
+                                timeout=results.timeout, password=password)
+    if run['truncated']:
+        run['return'] = 0
+        return run
+    if not run['success']:
+        raise Exception("Manifest failed with status %s: %s" %
+                        (run['exit_status'], run['error']))
+    current = parse_manifest(output.getvalue())
+    transfers = plan_transfers(previous, current, node_dir)
+
+    sftp = sftp_session(ip, 'root', password)
+    try:
+        size, failed = ship(sftp, node_dir, transfers)
+    finally:
+        sftp.close()
+
+    # Only remember what was actually shipped, failed files are shipped
+    # whole next time
+    for path in failed:
+        current.pop(path, None)
+    with open(state_file, "w") as f:
+        json.dump(current, f, indent=2)
+    return {'success': True,
+            'return': size,
+            'seconds': time.time() - start,
+            'files': len(transfers) - len(failed),
+            'truncated': None}
+
+
+def collect(collection):
+    node, node_name, cmd = collection[:3]
+    archive_file = "%s.tar.gz" % node_name
+    with open(archive_file, "wb") as f:
+        run = qa.stream_cmd_on_node(node, cmd, f,
+                                    max_bytes=results.max_size * 1024 * 1024,
+                                    timeout=results.timeout)
+    write_manifest(node, node_name, archive_file, run)
+    return run
+
+# Collect from every node at once
+if results.incremental:
+    if not os.path.isdir(results.log_dir):
+        os.makedirs(results.log_dir)
+    collector = collect_incremental
+else:
+    collector = collect
+for collection, run, error in qa.run_on_nodes(collector, collections):
+    node, node_name = collection[:2]
+    if error is not None:
+        print "Failed to collect logs from %s: %s" % (node, error)
+    elif run['truncated']:
+        print "Collection from %s ran over its %s budget" % (node,
+                                                             run['truncated'])
+    else:
+        print "Collected %s bytes from %s in %.2fs" % (run['return'], node,
+                                                       run['seconds'])
 
 # log environment
 if 'remote_chef' in local_env.override_attributes:
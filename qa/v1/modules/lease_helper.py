@@ -0,0 +1,155 @@
+#!/usr/bin/python
+
+'''
+Node pool lease helper
+'''
+
+import os
+import time
+import uuid
+import errno
+import atexit
+import socket
+from chef import DataBag, DataBagItem
+from chef.exceptions import ChefServerError
+
+
+class lease_helper:
+
+    def __init__(self, api, bag='qa_leases', lease_time=1800, settle=2):
+        """
+        Hands out leases on pool nodes as items of a data bag on the shared
+        chef server, so concurrent jobs on any host can never claim the same
+        node between searching for it and saving it
+        @param api: chef server holding the leases
+        @type api: chef.ChefAPI
+        @param bag: data bag with one item per leased node
+        @type bag: String
+        @param lease_time: seconds before an unreleased lease expires
+        @type lease_time: Integer
+        @param settle: seconds to wait before checking a taken over lease
+        @type settle: Integer
+        """
+        self.api = api
+        self.bag = bag
+        self.lease_time = lease_time
+        self.settle = settle
+        self.host = socket.gethostname()
+        self.owner = "%s:%s" % (self.host, os.getpid())
+        # name -> token of the lease item we wrote
+        self.held = {}
+        atexit.register(self.release_all)
+
+    def __repr__(self):
+        """
+        Print out current instance of lease_helper
+        """
+        outl = 'class :' + self.__class__.__name__
+
+        for attr in self.__dict__:
+            outl += '\n\t' + attr + ' : ' + str(getattr(self, attr))
+
+        return outl
+
+    def claim(self, names, count=1):
+        """
+        Leases count of the given node names, all or none of them
+        @param names: candidate node names, in order of preference
+        @type names: List
+        @param count: number of nodes wanted
+        @type count: Integer
+        @return List of count leased names, empty if fewer than count were
+        free, in which case none are left leased
+        """
+        claimed = []
+        for name in names:
+            if len(claimed) == count:
+                break
+            if self.take(name):
+                claimed.append(name)
+        if len(claimed) < count:
+            self.release(claimed)
+            return []
+        return claimed
+
+    def take(self, name):
+        """
+        Creates the lease item for name, or takes over an expired one
+        @return True if this process now holds the lease
+        """
+        token = uuid.uuid4().hex
+        lease = {'owner': self.owner,
+                 'expires': time.time() + self.lease_time,
+                 'token': token}
+        try:
+            self.create(name, lease)
+            self.held[name] = token
+            return True
+        except ChefServerError, e:
+            if e.code != 409:
+                raise
+
+        # Somebody holds or held it, only a lease that ran out is taken over
+        item = DataBagItem(self.bag, name, api=self.api)
+        if not item.exists or not self.expired(item, time.time()):
+            return False
+        item.raw_data.update(lease)
+        item.save()
+
+        # Two jobs can both see the same expired version, the last one to
+        # write it wins and every other one backs off
+        time.sleep(self.settle)
+        item = DataBagItem(self.bag, name, api=self.api)
+        if not item.exists or item['token'] != token:
+            return False
+        self.held[name] = token
+        return True
+
+    def create(self, name, lease):
+        """
+        Creates the lease item, failing with a 409 if it already exists
+        """
+        try:
+            DataBagItem.create(self.bag, name, api=self.api, **lease)
+        except ChefServerError, e:
+            if e.code != 404:
+                raise
+            # First lease ever, the bag is missing
+            try:
+                DataBag.create(self.bag, api=self.api)
+            except ChefServerError, e:
+                if e.code != 409:
+                    raise
+            DataBagItem.create(self.bag, name, api=self.api, **lease)
+
+    def release(self, names):
+        """
+        Gives back leases this process holds
+        """
+        for name in names:
+            token = self.held.pop(name, None)
+            if token is None:
+                continue
+            item = DataBagItem(self.bag, name, api=self.api)
+            if item.exists and item['token'] == token:
+                item.delete()
+
+    def release_all(self):
+        if self.held:
+            self.release(list(self.held))
+
+    def expired(self, lease, now):
+        """
+        A lease is over once it times out or its owner on this host died
+        """
+        if lease['expires'] < now:
+            return True
+        host, pid = lease['owner'].rsplit(':', 1)
+        return host == self.host and not self.alive(int(pid))
+
+    def alive(self, pid):
+        try:
+            os.kill(pid, 0)
+        except OSError, e:
+            return e.errno == errno.EPERM
+        return True
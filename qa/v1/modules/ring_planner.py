@@ -0,0 +1,164 @@
+#!/usr/bin/python
+
+'''
+Swift ring planner, simulates ring placement locally
+'''
+
+import math
+
+
+class ring_planner:
+
+    def __init__(self, devices, part_power=10, replicas=3):
+        """
+        Simulates how swift would spread partitions over a set of devices
+        @param devices: device dicts with zone, ip, device and weight, as
+                        rpcsqa_helper.swift_ring_layout builds them
+        @type devices: List
+        @param part_power: Power of 2 partitions in the ring
+        @type part_power: Integer
+        @param replicas: Copies of each partition
+        @type replicas: Integer
+        """
+        self.devices = devices
+        self.part_power = part_power
+        self.replicas = replicas
+
+    def __repr__(self):
+        """
+        Print out current instance of ring_planner
+        """
+        outl = 'class :' + self.__class__.__name__
+
+        for attr in self.__dict__:
+            outl += '\n\t' + attr + ' : ' + str(getattr(self, attr))
+
+        return outl
+
+    @classmethod
+    def from_inventory(cls, inventory, zones=3, **kwargs):
+        """
+        Lays an inventory out into zones the way build_swift_rings does
+        @param inventory: dicts of node ip and its disks, i.e.
+                          {"ip": "10.0.0.1", "disks": {"sdb1": 1000}}
+        @type inventory: List
+        """
+        devices = []
+        for index, node in enumerate(inventory):
+            for device, weight in sorted(node['disks'].items()):
+                devices.append({"zone": index % zones + 1,
+                                "ip": node['ip'],
+                                "device": device,
+                                "weight": weight})
+        return cls(devices, **kwargs)
+
+    def simulate(self):
+        """
+        Places every replica of every partition on the device that most
+        wants more partitions, preferring zones, then ips, then devices the
+        partition isn't on yet, much like swift's ring builder
+        @return Dict of the balance and failure domain coverage
+        """
+        parts = 2 ** self.part_power
+        total_weight = float(sum(d['weight'] for d in self.devices))
+        if total_weight <= 0:
+            raise ValueError("No device has any weight, there is nowhere "
+                             "to place partitions")
+        # Like swift, nothing is placed on a device without weight
+        placeable = [i for i, d in enumerate(self.devices) if d['weight'] > 0]
+        wanted = [parts * self.replicas * d['weight'] / total_weight
+                  for d in self.devices]
+        assigned = [0] * len(self.devices)
+        zones = set(self.devices[i]['zone'] for i in placeable)
+        ips = set(self.devices[i]['ip'] for i in placeable)
+
+        spread = 0
+        zone_losses = dict((zone, 0) for zone in zones)
+        for part in xrange(parts):
+            used = []
+            for replica in xrange(self.replicas):
+                def preference(index):
+                    device = self.devices[index]
+                    return (device['zone'] not in
+                            [self.devices[u]['zone'] for u in used],
+                            device['ip'] not in
+                            [self.devices[u]['ip'] for u in used],
+                            index not in used,
+                            wanted[index] - assigned[index])
+                index = max(placeable, key=preference)
+                assigned[index] += 1
+                used.append(index)
+            part_zones = set(self.devices[u]['zone'] for u in used)
+            if len(part_zones) >= min(self.replicas, len(zones)):
+                spread += 1
+            # A partition is lost with a zone when every replica is in it
+            if len(part_zones) == 1:
+                zone_losses[part_zones.pop()] += 1
+
+        # Per device, None for the ones without weight
+        balances = [100.0 * (assigned[i] / wanted[i] - 1)
+                    if i in placeable else None
+                    for i in xrange(len(self.devices))]
+        return {'partitions': parts,
+                'replicas': self.replicas,
+                'devices': len(placeable),
+                'zones': len(zones),
+                'ips': len(ips),
+                'balance': max(abs(balances[i]) for i in placeable),
+                'device_balance': balances,
+                'parts_per_device': min(assigned[i] for i in placeable),
+                'zone_coverage': 100.0 * spread / parts,
+                'lost_with_zone': max(zone_losses.values())}
+
+    @classmethod
+    def suggest(cls, devices, replicas=3):
+        """
+        Suggests ring parameters for a set of devices
+        @return Dict of the suggested part_power and replicas, plus warnings
+        """
+        warnings = []
+        devices = [d for d in devices if d['weight'] > 0]
+        if not devices:
+            raise ValueError("No device has any weight, there is nowhere "
+                             "to place partitions")
+        zones = len(set(d['zone'] for d in devices))
+        if zones < replicas:
+            warnings.append("Only {0} zones for {1} replicas, a zone "
+                            "failure takes out several replicas of a "
+                            "partition".format(zones, replicas))
+        # Swift wants at least 100 partitions per device to stay balanced
+        part_power = int(math.ceil(math.log(len(devices) * 100, 2)))
+        weights = set(d['weight'] for d in devices)
+        if len(weights) > 1:
+            warnings.append("Mixed device weights {0}, check the "
+                            "balance".format(sorted(weights)))
+        return {'part_power': part_power,
+                'replicas': min(replicas, len(devices)),
+                'warnings': warnings}
+
+    def report(self):
+        """
+        @return String describing the simulated ring
+        """
+        stats = self.simulate()
+        lines = ["Ring: 2^{0} partitions, {1} replicas over {2} devices, "
+                 "{3} ips, {4} zones".format(self.part_power,
+                                              stats['replicas'],
+                                              stats['devices'],
+                                              stats['ips'],
+                                              stats['zones']),
+                 "Balance: {0:.2f}% (fewest partitions on a device: "
+                 "{1})".format(stats['balance'],
+                               stats['parts_per_device']),
+                 "Partitions spread over as many zones as they can be: "
+                 "{0:.1f}%".format(stats['zone_coverage']),
+                 "Most partitions lost with a single zone: {0}".format(
+                     stats['lost_with_zone'])]
+        suggestion = self.suggest(self.devices, self.replicas)
+        if suggestion['part_power'] > self.part_power:
+            lines.append("Suggest part_power {0} or more for {1} "
+                         "devices".format(suggestion['part_power'],
+                                          stats['devices']))
+        lines.extend("Warning: {0}".format(w)
+                     for w in suggestion['warnings'])
+        return "\n".join(lines)
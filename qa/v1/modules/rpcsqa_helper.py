@@ -1,21 +1,76 @@
+import re
 import sys
 import time
 import json
+import urllib
 from math import *
 from chef import *
 from chef_helper import *
 from server_helper import *
+from lease_helper import lease_helper
 from cStringIO import StringIO
+from threading import Lock, RLock
 from razor_api import razor_api
+from ring_planner import ring_planner
+from chef.exceptions import ChefServerError
 from subprocess import check_call, CalledProcessError
 
 
-class rpcsqa_helper:
+class rpcsqa_helper(object):
+
+    # Node attributes partial_search returns unless asked for others
+    node_keys = {'name': ['name'],
+                 'chef_environment': ['chef_environment'],
+                 'run_list': ['run_list'],
+                 'in_use': ['in_use'],
+                 'ipaddress': ['ipaddress'],
+                 'razor_metadata': ['razor_metadata']}
+
+    # One helper per razor server for the life of the process
+    instances = {}
+    instances_lock = Lock()
+
+    def __new__(cls, razor_ip='198.101.133.3'):
+        with cls.instances_lock:
+            if razor_ip not in cls.instances:
+                helper = super(rpcsqa_helper, cls).__new__(cls)
+                helper.setup(razor_ip)
+                cls.instances[razor_ip] = helper
+            return cls.instances[razor_ip]
 
     def __init__(self, razor_ip='198.101.133.3'):
-        self.razor = razor_api(razor_ip)
+        # The shared instance was already set up by __new__
+        pass
+
+    def setup(self, razor_ip):
+        """
+        Clients are only loaded the first time they are used, so scripts
+        that never touch them start straight away. The chef api is the
+        exception: pychef keeps its default api per thread, so it is set
+        here on the constructing thread rather than on whichever worker
+        happens to use it first
+        """
+        self.razor_ip = razor_ip
+        self.lock = RLock()
+        self._razor = None
         self.chef = autoconfigure()
+        # Chef objects built without an api fall back to this one
         self.chef.set_default()
+        self._leases = None
+
+    @property
+    def razor(self):
+        with self.lock:
+            if self._razor is None:
+                self._razor = razor_api(self.razor_ip)
+        return self._razor
+
+    @property
+    def leases(self):
+        with self.lock:
+            if self._leases is None:
+                self._leases = lease_helper(self.chef)
+        return self._leases
 
     def __repr__(self):
         """ Print out current instance of razor_api"""
@@ -34,10 +89,12 @@ class rpcsqa_helper:
         # Gather all the nodes in the environment
         query = "chef_environment:{0}".format(environment)
 
-        for node in self.node_search(query, self.chef):
-            # dont need to reboot chef server
-            if not node['in_use'] == 'chef-server':
-                self.bring_up_dev_route(node, device)
+        # dont need to reboot chef server
+        nodes = [node for node in self.node_search(query, self.chef)
+                 if not node['in_use'] == 'chef-server']
+
+        bring_up = lambda node: self.bring_up_dev_route(node, device)
+        self.raise_first_error(self.run_on_nodes(bring_up, nodes))
 
     def bring_up_dev_route(self, node, device='eth1'):
         '''
@@ -103,27 +160,17 @@ class rpcsqa_helper:
             print "Platform is RHEL family, disabling iptables"
             self.disable_iptables(chef_node)
 
-        # Run chef-client twice
+        # Run chef-client until converged
         print "Running chef-client for directory service node, \
         this may take some time..."
-        run1 = self.run_chef_client(chef_node)
-        if run1['success']:
-            print "First chef-client run successful...starting second run..."
-            run2 = self.run_chef_client(chef_node)
-            if run2['success']:
-                print "Second chef-client run successful..."
-            else:
-                print "Error running chef-client for directory node %s" \
-                    % chef_node
-                print run2
-                sys.exit(1)
-        else:
+        run = self.converge_chef_client(chef_node)
+        if not run['success']:
             print "Error running chef-client for directory node %s" % chef_node
-            print run1
+            print run
             sys.exit(1)
 
         #Save the ip address of the ldap server into the environment
-        env = Environment(chef_node.chef_environment)
+        env = Environment(chef_node.chef_environment, api=self.chef)
         env.override_attributes['keystone']['ldap']['url'] = "ldap://%s" % chef_node['ipaddress']
         env.save()
 
@@ -133,7 +180,7 @@ class rpcsqa_helper:
             f.write(json.dumps(env.to_dict()))
 
         # Directory service is set up, need to import config
-        if run1['success'] and run2['success']:
+        if run['success']:
             if dir_version == 'openldap':
                 scp_run = run_remote_scp_cmd(ip, 'root', user_pass, '/var/lib/jenkins/source_files/ldif/*.ldif')
                 if scp_run['success']:
@@ -179,23 +226,13 @@ class rpcsqa_helper:
                 print "Platform is RHEL family, disabling iptables"
                 self.disable_iptables(compute_node)
 
-            # Run chef client twice
+            # Run chef-client until converged
             print "Running chef-client on compute node: %s, \
                    this may take some time..." % compute
-            run1 = self.run_chef_client(compute_node)
-            if run1['success']:
-                print "First chef-client run successful, \
-                       starting second run..."
-                run2 = self.run_chef_client(compute_node)
-                if run2['success']:
-                    print "Second chef-client run successful..."
-                else:
-                    print "Error running chef-client for compute %s" % compute
-                    print run2
-                    sys.exit(1)
-            else:
+            run = self.converge_chef_client(compute_node)
+            if not run['success']:
                 print "Error running chef-client for compute %s" % compute
-                print run1
+                print run
                 sys.exit(1)
 
     def build_computes(self, computes, environment, remote=False, chef_config_file=None):
@@ -226,23 +263,13 @@ class rpcsqa_helper:
                     print "Platform is RHEL family, disabling iptables"
                     self.disable_iptables(compute_node)
 
-                # Run chef client twice
+                # Run chef-client until converged
                 print "Running chef-client on compute node: %s, \
                        this may take some time..." % compute
-                run1 = self.run_chef_client(compute_node)
-                if run1['success']:
-                    print "First chef-client run successful, \
-                           starting second run..."
-                    run2 = self.run_chef_client(compute_node)
-                    if run2['success']:
-                        print "Second chef-client run successful..."
-                    else:
-                        print "Error running chef-client for compute %s" % compute
-                        print run2
-                        sys.exit(1)
-                else:
+                run = self.converge_chef_client(compute_node)
+                if not run['success']:
                     print "Error running chef-client for compute %s" % compute
-                    print run1
+                    print run
                     sys.exit(1)
 
     def build_controller(self, controller_node, environment=None, ha_num=0, neutron=False, remote=False, chef_config_file=None):
@@ -284,21 +311,12 @@ class rpcsqa_helper:
                 print "Platform is RHEL family, disabling iptables"
                 self.disable_iptables(chef_node)
 
-            # Run chef-client twice
+            # Run chef-client until converged
             print "Running chef-client for controller node, this may take some time..."
-            run1 = self.run_chef_client(chef_node)
-            if run1['success']:
-                print "First chef-client run successful, starting second run..."
-                run2 = self.run_chef_client(chef_node)
-                if run2['success']:
-                    print "Second chef-client run successful..."
-                else:
-                    print "Error running chef-client for controller %s" % controller_node
-                    print run2
-                    sys.exit(1)
-            else:
+            run = self.converge_chef_client(chef_node)
+            if not run['success']:
                 print "Error running chef-client for controller %s" % controller_node
-                print run1
+                print run
                 sys.exit(1)
 
     def build_chef_server(self, chef_server_node):
@@ -367,21 +385,12 @@ class rpcsqa_helper:
                 print "Platform is RHEL family, disabling iptables"
                 self.disable_iptables(chef_node)
 
-            # Run chef-client twice
+            # Run chef-client until converged
             print "Running chef-client for controller node, this may take some time..."
-            run1 = self.run_chef_client(chef_node)
-            if run1['success']:
-                print "First chef-client run successful, starting second run..."
-                run2 = self.run_chef_client(chef_node)
-                if run2['success']:
-                    print "Second chef-client run successful..."
-                else:
-                    print "Error running chef-client for controller %s" % quantum_node
-                    print run2
-                    sys.exit(1)
-            else:
+            run = self.converge_chef_client(chef_node)
+            if not run['success']:
                 print "Error running chef-client for controller %s" % quantum_node
-                print run1
+                print run
                 sys.exit(1)
 
     def build_swift_node(self, swift_node, swift_role, environment, remote=False, chef_config_file=None):
@@ -408,21 +417,12 @@ class rpcsqa_helper:
                 print "Platform is RHEL family, disabling iptables"
                 self.disable_iptables(chef_node)
 
-            # Run chef-client twice
+            # Run chef-client until converged
             print "Running chef-client for controller node, this may take some time..."
-            run1 = self.run_chef_client(chef_node)
-            if run1['success']:
-                print "First chef-client run successful, starting second run..."
-                run2 = self.run_chef_client(chef_node)
-                if run2['success']:
-                    print "Second chef-client run successful..."
-                else:
-                    print "Error running chef-client for controller %s" % swift_node
-                    print run2
-                    sys.exit(1)
-            else:
+            run = self.converge_chef_client(chef_node)
+            if not run['success']:
                 print "Error running chef-client for controller %s" % swift_node
-                print run1
+                print run
                 sys.exit(1)
 
     def build_swift_rings(self, build, management_node, proxy_nodes, storage_nodes, num_rings=3, part_power=10, replicas=3, min_part_hours=1, disk_weight=1000):
@@ -448,180 +448,152 @@ class rpcsqa_helper:
         @type disk_weight Integer
         '''
 
-        #################################################################################
-        ############ Run through the storage nodes and set up the disks #################
-        #################################################################################
-
         disk = "sdb"
         disk_label = "sdb1"
-        for storage_node in storage_nodes:
-            commands = ["/usr/local/bin/swift-partition.sh {0}".format(disk),
-                        "/usr/local/bin/swift-format.sh {0}".format(disk_label),
-                        "mkdir -p /srv/node/{0}".format(disk_label),
-                        "mount -t xfs -o noatime,nodiratime,logbufs=8 /dev/{0} /srv/node/{0}".format(disk_label),
-                        "chown -R swift:swift /srv/node"]
-
-            if build:
-                print "#" * 60
-                print "##### Configuring Disks on Storage Node @ {0}#####".format(storage_node['ip'])
-                print "#" * 60
-                command = "; ".join(commands)
-                run = self.run_cmd_on_node(storage_node['node'], command)
-                if not run['success']:
-                    self.failed_ssh_command_exit(command, storage_node['node'], run['error'])
-            else:
-                print "##### Info to setup drives for Swift #####"
+        disk_commands = ["/usr/local/bin/swift-partition.sh {0}".format(disk),
+                         "/usr/local/bin/swift-format.sh {0}".format(disk_label),
+                         "mkdir -p /srv/node/{0}".format(disk_label),
+                         "mount -t xfs -o noatime,nodiratime,logbufs=8 /dev/{0} /srv/node/{0}".format(disk_label),
+                         "chown -R swift:swift /srv/node"]
+
+        layout = self.swift_ring_layout(storage_nodes, num_rings, disk_label,
+                                        disk_weight)
+        print ring_planner(layout['object'], part_power, replicas).report()
+        script = self.swift_ring_script(layout, part_power, replicas,
+                                        min_part_hours)
+        # Rings are built as swiftops, feeding the script in on stdin
+        ring_command = "su swiftops -c 'bash -s' <<'RINGS'\n{0}RINGS".format(
+            script)
+        pull_command = "/usr/local/bin/pull-rings.sh"
+
+        if not build:
+            print "##### Info to setup drives for Swift #####"
+            for storage_node in storage_nodes:
                 print "##### Log into root@{0} with pass: {1} and run the following commands: #####".format(storage_node['ip'], storage_node['password'])
-                for command in commands:
+                for command in disk_commands:
                     print command
-
-        #################################################################################
-        ######## Setup partitions on storage nodes, (must run as swiftops user) #########
-        #################################################################################
-        commands = ["su swiftops",
-                    "mkdir -p ~/swift/rings",
-                    "cd ~/swift/rings",
-                    "git init .",
-                    "echo \"backups\" > .gitignore",
-                    "swift-ring-builder object.builder create {0} {1} {2}".format(part_power, replicas, min_part_hours),
-                    "swift-ring-builder container.builder create {0} {1} {2}".format(part_power, replicas, min_part_hours),
-                    "swift-ring-builder account.builder create {0} {1} {2}".format(part_power, replicas, min_part_hours)]
-
-        # Determine how many storage nodes we have and add them appropriatly
-        builders = [
-            {
-                "name": "object",
-                "port": 6000
-            },
-            {
-                "name": "container",
-                "port": 6001
-            },
-            {
-                "name": "account",
-                "port": 6002
-            }
-        ]
-
-        for builder in builders:
-            for index, node in enumerate(storage_nodes):
-
-                # if the current index of the node is % num_rings = 0,
-                # reset num so we dont add anymore rings past num_rings
-                if index % num_rings is 0:
-                    num = 0
-
-                # Add the line to command to build the object
-                commands.append("swift-ring-builder {0}.builder add z{1}-{2}:{3}/{4} {5}".format(builder['name'],
-                                                                                                  num + 1,
-                                                                                                  node['ip'],
-                                                                                                  builder['port'],
-                                                                                                  disk_label,
-                                                                                                  disk_weight))
-                num += 1
-
-        # Finish the command list
-        cmd_list = ["swift-ring-builder object.builder rebalance",
-                    "swift-ring-builder container.builder rebalance",
-                    "swift-ring-builder account.builder rebalance",
-                    "git remote add origin /srv/git/rings",
-                    "git add .",
-                    "git config user.email \"swiftops@swiftops.com\"",
-                    "git config user.name \"swiftops\"",
-                    "git commit -m \"initial checkin\"",
-                    "git push origin master"]
-
-        for command in cmd_list:
-            commands.append(command)
-
-        if build:
             print "#" * 60
-            print "##### Setting up swift rings for cluster #####"
+            print "##### Info to manually set up swift rings: #####"
+            print "##### Log into root@{0} with pass: {1} and run the following as swiftops: ".format(management_node['ip'], management_node['password'])
+            print script
             print "#" * 60
-
-            # join all the commands into a single command, seperated by ";"
-            command = '; '.join(commands)
-
-            # Run the command on the swift management node
-            run = self.run_cmd_on_node(management_node['node'], command)
+            print "##### Then on the management node, each proxy node and each storage node run: #####"
+            for node in [management_node] + proxy_nodes + storage_nodes:
+                print "##### root@{0} with pass: {1} #####".format(node['ip'], node['password'])
+            print pull_command
+            return
+
+        def run_job(job):
+            node, command = job
+            run = self.run_cmd_on_node(node['node'], command)
             if not run['success']:
-                self.failed_ssh_command_exit(command, management_node['node'], run['error'])
-
-        else:
-            # loop through and print each command for the user to run
-            print "#" * 60
-            print "##### Info to manually set up swift rings: #####"
-            print "##### Log into root@{0} with pass: {1} and run the following commands: ".format(management_node['ip'], management_node['password'])
-            for command in commands:
-                print command
-
-        ######################################################################################
-        ################## Time to distribute the ring to all the boxes ######################
-        ######################################################################################
-        command = "/usr/local/bin/pull-rings.sh"
+                self.failed_ssh_command_exit(command, node['node'],
+                                             run['error'])
 
+        # Rings don't need the disks, so build them while the disks are set up
         print "#" * 60
-        print "##### PULL RING ONTO MANAGEMENT NODE #####"
-        if build:
-            print "##### Pulling Swift ring on Management Node #####"
-            run = self.run_cmd_on_node(management_node['node'], cmd, user, password)
-            if not run['success']:
-                self.failed_ssh_command_exit(command, management_node['node'], run['error'])
-        else:
-            print "##### On node root@{0} with pass: {1} and run the following command: #####".format(management_node['ip'], management_node['password'])
-            print command
+        print "##### Configuring disks on {0} storage nodes and building rings on {1} #####".format(len(storage_nodes), management_node['ip'])
+        print "#" * 60
+        jobs = [(storage_node, "; ".join(disk_commands))
+                for storage_node in storage_nodes]
+        jobs.append((management_node, ring_command))
+        self.raise_first_error(self.run_on_nodes(run_job, jobs))
 
+        # Everyone else pulls the rings from the management node's copy
         print "#" * 60
-        print "##### PULL RING ONTO PROXY NODES #####"
-        for proxy_node in proxy_nodes:
-            if build:
-                print "##### Pulling swift ring down on proxy node @ {0}: #####".format(proxy_node['ip'])
-                run = self.run_cmd_on_node(proxy_node['node'], command)
-                if not run['success']:
-                    self.failed_ssh_command_exit(command, proxy_node['node'], run['error'])
-            else:
-                print "##### On node root@{0} with pass: {1} and run the following command: #####".format(proxy_node['ip'], proxy_node['password'])
-                print command
+        print "##### Pulling swift rings onto the management node #####"
+        run_job((management_node, pull_command))
 
         print "#" * 60
-        print "##### PULL RING ONTO STORAGE NODES #####"
-        for storage_node in storage_nodes:
-            if build:
-                print "##### Pulling swift ring down storage node: {0} #####".format(storage_node['ip'])
-                run = self.run_cmd_on_node(storage_node['node'], command)
-                if not run['success']:
-                    self.failed_ssh_command_exit(command, storage_node['node'], run['error'])
-            else:
-                print "##### On node root@{0} with pass: {1} and run the following command: #####".format(storage_node['ip'], storage_node['password'])
-                print command
+        print "##### Pulling swift rings onto proxy and storage nodes #####"
+        jobs = [(node, pull_command) for node in proxy_nodes + storage_nodes]
+        self.raise_first_error(self.run_on_nodes(run_job, jobs))
 
         print "#" * 60
         print "##### Done setting up swift rings #####"
 
+    def swift_ring_layout(self, storage_nodes, num_rings=3, disk_label="sdb1",
+                          disk_weight=1000):
+        """
+        @summary Lays the storage nodes out into zones for each ring builder
+        @return Dict of builder name to a list of device dicts (zone, ip,
+        port, device and weight)
+        """
+        ports = {"object": 6000, "container": 6001, "account": 6002}
+        layout = {}
+        for name, port in ports.items():
+            layout[name] = [{"zone": index % num_rings + 1,
+                             "ip": node['ip'],
+                             "port": port,
+                             "device": disk_label,
+                             "weight": disk_weight}
+                            for index, node in enumerate(storage_nodes)]
+        return layout
+
+    def swift_ring_script(self, layout, part_power=10, replicas=3,
+                          min_part_hours=1):
+        """
+        @summary Writes one shell script that builds every ring in layout
+        concurrently and checks them into the management node's ring repo
+        @return String
+        """
+        lines = ["mkdir -p ~/swift/rings",
+                 "cd ~/swift/rings",
+                 "git init .",
+                 "echo \"backups\" > .gitignore",
+                 "pids=\"\""]
+        for name in sorted(layout):
+            builder = "{0}.builder".format(name)
+            lines.append("(")
+            lines.append("set -e")
+            lines.append("swift-ring-builder {0} create {1} {2} {3}".format(
+                builder, part_power, replicas, min_part_hours))
+            for device in layout[name]:
+                lines.append("swift-ring-builder {0} add "
+                             "z{zone}-{ip}:{port}/{device} {weight}".format(
+                                 builder, **device))
+            # rebalance exits 1 for warnings, i.e. a less than ideal balance
+            lines.append("swift-ring-builder {0} rebalance || "
+                         "[ $? -eq 1 ]".format(builder))
+            lines.append(") &")
+            lines.append("pids=\"$pids $!\"")
+        # A bare wait always succeeds, check every builder on its own
+        lines.extend(["for pid in $pids; do wait $pid || exit 1; done",
+                      "git remote add origin /srv/git/rings",
+                      "git add .",
+                      "git config user.email \"swiftops@swiftops.com\"",
+                      "git config user.name \"swiftops\"",
+                      "git commit -m \"initial checkin\"",
+                      "git push origin master"])
+        return "\n".join(lines) + "\n"
+
     def check_cluster_size(self, chef_nodes, size):
         if len(chef_nodes) < size:
             return False
 
         return True
 
-    def cleanup_environment(self, chef_environment):
+    def cleanup_environment(self, chef_environment, wait=False):
         """
         @param chef_environment
+        @param wait Block until erased nodes are back in the pool
+        @return erase_nodes teardown report
         """
-        nodes = Search('node', api=self.chef).query("chef_environment:%s" % chef_environment)
+        nodes = list(self.node_search("chef_environment:%s" % chef_environment))
+        dirty = []
         if nodes:
-            for n in nodes:
-                name = n['name']
+            for node in nodes:
+                name = node.name
                 print "Node {0} belongs to chef environment {1}".format(name, chef_environment)
-                node = Node(name, api=self.chef)
                 if node['in_use'] != 0:
-                    self.erase_node(node)
+                    dirty.append(node)
                 else:
                     print "Setting node {0} to chef environment _default".format(name)
                     node.chef_environment = "_default"
                     node.save()
         else:
             print "Environment: %s has no nodes" % chef_environment
+        return self.erase_nodes(dirty, wait=wait)
 
     def clone_rso_git_repo(self, server, github_user, github_pass):
         chef_node = Node(server, api=self.chef)
@@ -686,16 +658,13 @@ class rpcsqa_helper:
 
     def environment_has_controller(self, environment):
         # Load Environment
-        nodes = Search('node', api=self.chef).query("chef_environment:%s" % environment)
+        nodes = self.partial_search("chef_environment:%s" % environment,
+                                    {'run_list': ['run_list']})
         roles = ['role[qa-single-controller]',
                  'role[qa-ha-controller1]',
                  'role[qa-ha-controller2]']
-        for node in nodes:
-            chef_node = Node(node['name'], api=self.chef)
-            if any(x in chef_node.run_list for x in roles):
-                return True
-            else:
-                return False
+        return any(x in (node['run_list'] or []) for node in nodes
+                   for x in roles)
 
     def erase_node(self, chef_node):
         """
@@ -708,13 +677,81 @@ class rpcsqa_helper:
         if not run['success']:
             self.failed_ssh_command_exit(command, chef_node, run['error'])
 
+        # The reboot takes the pooled ssh connection down with it
+        pool.discard(chef_node['ipaddress'])
+
         #Knife node remove; knife client remove
-        Client(str(chef_node)).delete()
+        Client(str(chef_node), api=self.chef).delete()
         chef_node.delete()
 
         #Remove active model
         self.razor.remove_active_model(am_uuid)
-        time.sleep(15)
+
+    def erase_nodes(self, chef_nodes, wait=True, timeout=1800, interval=30):
+        """
+        @summary Erases nodes concurrently. Unless wait is False, then polls
+        razor until each node is bound to a new active model and brokered
+        back into the pool. The rekicked box comes back under a new chef
+        name, so it is tracked by its razor node uuid.
+        @param wait Block until the nodes are back, or fire and forget
+        @type wait Boolean
+        @param timeout Seconds to wait for nodes to come back
+        @type timeout Integer
+        @return Dict of node name to {'erased', 'error', 'returned',
+        'seconds'}, returned is None when not waited on
+        """
+        # Look the razor node up first, removing the active model drops it
+        # from the cache
+        razor_nodes = {}
+        for chef_node in chef_nodes:
+            am_uuid = chef_node['razor_metadata']['razor_active_model_uuid']
+            metadata = self.razor.get_active_model_metadata(am_uuid) or {}
+            razor_nodes[chef_node.name] = (am_uuid, metadata.get('node_uuid'))
+
+        start = time.time()
+        report = {}
+        for node, ret, error in self.run_on_nodes(self.erase_node,
+                                                  chef_nodes):
+            report[node.name] = {'erased': error is None,
+                                 'error': None if error is None
+                                 else str(error),
+                                 'returned': None,
+                                 'seconds': None}
+        pending = set(name for name in report
+                      if report[name]['erased'] and razor_nodes[name][1])
+        while wait and pending and time.time() - start < timeout:
+            time.sleep(interval)
+            active_models = self.razor.simple_active_models()
+            if not isinstance(active_models, dict):
+                continue
+            for name in list(pending):
+                am_uuid, node_uuid = razor_nodes[name]
+                # The node is back once razor has bound it to a new active
+                # model and its broker has run
+                if any(am['node_uuid'] == node_uuid and
+                       am['am_uuid'] != am_uuid and
+                       ('broker_success' in am['current_state'] or
+                        'complete' in am['current_state'])
+                       for am in active_models.values()):
+                    report[name]['returned'] = True
+                    report[name]['seconds'] = int(time.time() - start)
+                    pending.discard(name)
+        if wait:
+            for name in pending:
+                report[name]['returned'] = False
+
+        failed = []
+        for name, status in sorted(report.items()):
+            if not status['erased']:
+                print "Failed to erase %s: %s" % (name, status['error'])
+                failed.append(name)
+            elif status['returned'] is False:
+                print "%s has not returned to the pool" % name
+        if failed:
+            print "## Failed to erase {0} ##".format(", ".join(failed))
+            print "## EXITING ##"
+            sys.exit(1)
+        return report
 
     def failed_ssh_command_exit(self, cmd, chef_node, error_message):
 
@@ -730,27 +767,49 @@ class rpcsqa_helper:
 
     def gather_size_nodes(self, os, environment, cluster_size):
         ret_nodes = []
-        count = 0
 
         # Gather the nodes for the requested OS
-        nodes = Search('node', api=self.chef).query("name:qa-%s-pool*" % os)
-
-        # Take a node from the default environment that
-        # has its network interfaces set.
-        for n in nodes:
-            name = n['name']
-            node = Node(name, api=self.chef)
-            if ((node.chef_environment == "_default" or
-                node.chef_environment == environment) and
-                    "recipe[network-interfaces]" in node.run_list):
-                self.set_nodes_environment(node, environment)
-                ret_nodes.append(name)
-                print "Taking node: %s" % name
-                count += 1
-
-                if count >= cluster_size:
+        nodes = self.partial_search("name:qa-%s-pool*" % os)
+
+        # Take nodes already in the environment or from the default
+        # environment that have their network interfaces set.
+        ready = [n for n in nodes
+                 if "recipe[network-interfaces]" in (n['run_list'] or [])]
+        for n in ready:
+            if n['chef_environment'] == environment and \
+                    len(ret_nodes) < cluster_size:
+                print "Taking node: %s" % n['name']
+                ret_nodes.append(n['name'])
+        free = [n['name'] for n in ready if n['chef_environment'] == "_default"]
+
+        # Lease free nodes while moving them so concurrent builds never
+        # take the same one
+        taken = []
+        try:
+            while len(ret_nodes) < cluster_size:
+                names = self.leases.claim(free, cluster_size - len(ret_nodes))
+                if not names:
                     break
-
+                free = [name for name in free if name not in names]
+                try:
+                    for name in names:
+                        # The search index lags, make sure nobody beat us to it
+                        node = Node(name, api=self.chef)
+                        if node.chef_environment != "_default":
+                            continue
+                        self.set_nodes_environment(node, environment)
+                        taken.append(node)
+                        ret_nodes.append(name)
+                        print "Taking node: %s" % name
+                finally:
+                    self.leases.release(names)
+        except Exception:
+            # Hand back the nodes already moved rather than strand them
+            for node in taken:
+                self.set_nodes_environment(node, "_default")
+            raise
+
+        count = len(ret_nodes)
         if count < cluster_size:
             print "Not enough available nodes for requested cluster size of %s, try again later..." % cluster_size
             # Sleep for 10 seconds, this time doesnt matter as the build isnt going to happen
@@ -958,22 +1017,79 @@ class rpcsqa_helper:
     def node_search(self, query=None, api=None):
         api = api or self.chef
         search = Search("node", api=api).query(query)
-        return (Node(n['name'], api=api) for n in search)
+        # The rows already hold the whole node, no need to GET each one
+        return (n.object for n in search)
+
+    def partial_search(self, query, keys=None, api=None, rows=1000):
+        """
+        @summary Searches chef for nodes returning only the attributes asked
+        for, in one request per page instead of a GET per node
+        @param query Chef node search
+        @type query String
+        @param keys Dict of result key to attribute path, i.e.
+        {'ip': ['ipaddress']}, defaults to node_keys
+        @type keys Dict
+        @return List of dicts, one per node
+        """
+        api = api or self.chef
+        keys = keys or self.node_keys
+        try:
+            results = []
+            start = 0
+            while True:
+                path = "/search/node?" + urllib.urlencode({'q': query,
+                                                           'start': start,
+                                                           'rows': rows})
+                # api_request encodes the body itself
+                page = api.api_request('POST', path, data=keys)
+                results.extend(row['data'] for row in page['rows'])
+                start += len(page['rows'])
+                if not page['rows'] or start >= page['total']:
+                    return results
+        except ChefServerError, e:
+            # Chef server without partial search, pick the attributes out
+            # of the full search rows instead
+            print "## Partial search failed, falling back to a full " \
+                "search: %s ##" % e
+            search = Search("node", api=api).query(query)
+            return [self.pick_attributes(row, keys) for row in search]
+
+    def pick_attributes(self, row, keys):
+        """
+        Pulls attribute paths out of a full node search row the way partial
+        search would, honouring chef's attribute precedence
+        """
+        picked = {}
+        for key, path in keys.iteritems():
+            value = None
+            if path[0] in row:
+                value = row
+            else:
+                for level in ('automatic', 'override', 'normal', 'default'):
+                    if path[0] in row.get(level, {}):
+                        value = row[level]
+                        break
+            for part in path:
+                value = value.get(part) if isinstance(value, dict) else None
+            picked[key] = value
+        return picked
 
     def ping_check_cluster(self, environment):
 
         # Gather all the nodes in the environment
         query = "chef_environment:{0}".format(environment)
 
+        # Dont need to check the chef server
+        nodes = [node for node in self.node_search(query, self.chef)
+                 if not node['in_use'] == 'chef-server']
+
         online = False
         offline = False
-        for node in self.node_search(query, self.chef):
-            # Dont need to check the chef server
-            if not node['in_use'] == 'chef-server':
-                if self.ping_check_node(node) is False:
-                    offline = True
-                else:
-                    online = True
+        for node, up, error in run_parallel(self.ping_check_node, nodes):
+            if up is True:
+                online = True
+            else:
+                offline = True
 
         return {"online": online, "offline": offline}
 
@@ -985,12 +1101,16 @@ class rpcsqa_helper:
 
     def prepare_environment(self, name, os_distro, feature_set, branch=None):
         # Gather the nodes for the requested os_distro
-        nodes = Search('node', api=self.chef).query("name:qa-%s-pool*" % os_distro)
+        nodes = self.partial_search("name:qa-%s-pool*" % os_distro,
+                                    {'name': ['name'],
+                                     'run_list': ['run_list']})
 
-        #Make sure all network interfacing is set
-        for node in nodes:
-            chef_node = Node(node['name'], api=self.chef)
-            self.set_network_interface(chef_node)
+        #Make sure all network interfacing is set, only the nodes that
+        #still need it are worth loading
+        chef_nodes = [Node(node['name'], api=self.chef) for node in nodes
+                      if "role[qa-base]" in (node['run_list'] or [])]
+        self.raise_first_error(
+            self.run_on_nodes(self.set_network_interface, chef_nodes))
 
         # If the branch isnt set, set it to the feature (for opencenter)
         if branch is None:
@@ -1056,7 +1176,11 @@ class rpcsqa_helper:
         return "%s - %s" % (chef_node, chef_node['ipaddress'])
 
     def razor_password(self, chef_node):
-        node = Node(chef_node.name, api=self.chef)
+        node = chef_node
+        # Only refetch nodes that didn't come with razor's metadata,
+        # i.e. ones loaded from a remote chef server
+        if 'razor_metadata' not in node.attributes:
+            node = Node(chef_node.name, api=self.chef)
         metadata = node.attributes['razor_metadata'].to_dict()
         uuid = metadata['razor_active_model_uuid']
         return self.razor.get_active_model_pass(uuid)['password']
@@ -1084,8 +1208,8 @@ class rpcsqa_helper:
                 ip = data['eth1_ip']
                 run = run_remote_ssh_cmd(ip, 'root', user_pass, 'reboot 0')
                 if run['success']:
+                    pool.discard(ip)
                     self.razor.remove_active_model(data['am_uuid'])
-                    time.sleep(15)
                 else:
                     print "!!## -- Trouble removing broker fail -- ##!!"
                     print run
@@ -1104,6 +1228,82 @@ class rpcsqa_helper:
         print "### On: %s - %s ###" % (node.name, ip)
         return run_remote_ssh_cmd(ip, user, password, cmd)
 
+    def stream_cmd_on_node(self, node, cmd, sink, max_bytes=None,
+                           timeout=None, user=None, password=None):
+        """
+        @summary Runs cmd on node, writing its output straight into sink
+        @param sink File like object the output is written to
+        @param max_bytes Most bytes of output to take
+        @type max_bytes Integer
+        @param timeout Most seconds to let cmd run
+        @type timeout Integer
+        @return run_remote_stream_cmd result
+        """
+        user = user or "root"
+        password = password or self.razor_password(node)
+        ip = node['ipaddress']
+        print "### Streaming: %s ###" % cmd
+        print "### On: %s - %s ###" % (node.name, ip)
+        return run_remote_stream_cmd(ip, user, password, cmd, sink,
+                                     max_bytes, timeout)
+
+    def run_cmd_on_environment(self, query, cmd, max_workers=10, user=None,
+                               password=None, private=False):
+        """
+        @summary Runs cmd on every node matching a chef search at once
+        @param query Chef node search, i.e. "chef_environment:foo"
+        @type query String
+        @param cmd Command to run on each node
+        @type cmd String
+        @param max_workers Most nodes to run on at the same time
+        @type max_workers Integer
+        @return Dict of node name to run_remote_ssh_cmd result
+        """
+        nodes = self.node_search(query, self.chef)
+        return self.run_cmd_on_nodes(nodes, cmd, max_workers, user, password,
+                                     private)
+
+    def run_cmd_on_nodes(self, nodes, cmd, max_workers=10, user=None,
+                         password=None, private=False):
+        """
+        @summary Runs cmd on a list of chef nodes at once
+        @return Dict of node name to run_remote_ssh_cmd result
+        """
+        run = lambda node: self.run_cmd_on_node(node, cmd, user, password,
+                                                private)
+        results = {}
+        for node, ret, error in self.run_on_nodes(run, nodes, max_workers):
+            if error is not None:
+                ret = {'success': False,
+                       'return': "",
+                       'exit_status': -1,
+                       'error': str(error)}
+            results[node.name] = ret
+        return results
+
+    def run_on_nodes(self, func, nodes, max_workers=10):
+        """
+        Fans func out over nodes with this helpers chef api as the default
+        in every worker thread
+        @return list of (node, result, exception)
+        """
+        def run(node):
+            with self.chef:
+                return func(node)
+        return run_parallel(run, nodes, max_workers)
+
+    def raise_first_error(self, results):
+        """
+        Re-raises the first error (including sys.exit) hit by a worker
+        """
+        for node, ret, error in results:
+            if error is not None:
+                raise error
+
+    # Chef's summary line, i.e. "Chef Client finished, 3/120 resources
+    # updated" or "3 resources updated"
+    updated_pattern = re.compile(r'(\d+)(?:/\d+)? resources updated')
+
     def run_chef_client(self, chef_node):
         """
         @param chef_node
@@ -1112,21 +1312,66 @@ class rpcsqa_helper:
         """
         ip = chef_node['ipaddress']
         user_pass = self.razor_password(chef_node)
+        # The formatter is forced so the resources updated summary prints
+        # without a tty
         return run_remote_ssh_cmd(ip,
                                   'root',
                                   user_pass,
-                                  'chef-client')
+                                  'chef-client --force-formatter')
+
+    def converge_chef_client(self, chef_node, max_runs=2):
+        """
+        @summary Runs chef-client up to max_runs times, only running it again
+        while the last run failed or updated resources
+        @param max_runs Most times to run chef-client
+        @type max_runs Integer
+        @return Dict of success, whether the node converged and the runs,
+        each with its 'seconds' and 'updated' resources (None if chef didn't
+        say)
+        """
+        runs = []
+        for i in xrange(max_runs):
+            start = time.time()
+            run = self.run_chef_client(chef_node)
+            run['seconds'] = time.time() - start
+            run['updated'] = self.updated_resources(run)
+            runs.append(run)
+            updated = "unknown" if run['updated'] is None else run['updated']
+            print "chef-client run {0} on {1}: {2} resources updated in " \
+                "{3:.0f}s".format(i + 1, chef_node.name, updated,
+                                  run['seconds'])
+            if run['success'] and run['updated'] == 0:
+                break
+        last = runs[-1]
+        return {'success': last['success'],
+                'converged': last['success'] and last['updated'] == 0,
+                'runs': runs}
+
+    def updated_resources(self, run):
+        """
+        @summary Gets how many resources a chef-client run updated from its
+        summary
+        @return Integer, or None when the output has no summary
+        """
+        counts = self.updated_pattern.findall(run['return'])
+        if counts:
+            return int(counts[-1])
+        return None
 
     def reboot_cluster(self, environment):
 
         # Gather all the nodes in the environment
         query = "chef_environment:{0}".format(environment)
 
-        for node in self.node_search(query, self.chef):
-            # dont need to reboot chef server
-            if not node['in_use'] == 'chef-server':
-                if self.ping_check_node(node) is True:
-                    self.reboot_node(node)
+        # dont need to reboot chef server
+        nodes = [node for node in self.node_search(query, self.chef)
+                 if not node['in_use'] == 'chef-server']
+
+        # Only reboot the nodes that are up
+        online = [node for node, up, error
+                  in run_parallel(self.ping_check_node, nodes)
+                  if up is True]
+        self.raise_first_error(self.run_on_nodes(self.reboot_node, online))
 
     def reboot_node(self, chef_node):
         command = 'reboot 0'
@@ -1154,11 +1399,11 @@ class rpcsqa_helper:
             self.failed_ssh_command_exit(command, chef_node, run['error'])
 
     def remove_empty_environments(self):
-        search = Search("environment").query("NOT name:_default")
+        search = Search("environment", api=self.chef).query("NOT name:_default")
         for e in search:
-            if not Search("node").query("chef_environment:%s" % e['name']):
+            if not Search("node", api=self.chef).query("chef_environment:%s" % e['name']):
                 print "Deleting empty environment: %s" % e['name']
-                env = Environment(e['name'])
+                env = Environment(e['name'], api=self.chef)
                 env.delete()
 
     def scp_from_node(self, node=None, path=None, destination=None, user=None, password=None):
@@ -1213,18 +1458,15 @@ class rpcsqa_helper:
             chef_node.save()
             print "Running network interfaces for %s" % chef_node
 
-            #Run chef client thrice
-            run1 = self.run_chef_client(chef_node)
-            run2 = self.run_chef_client(chef_node)
-            run3 = self.run_chef_client(chef_node)
+            #Run chef client until converged, at most thrice
+            run = self.converge_chef_client(chef_node, max_runs=3)
 
-            if run1['success'] and run2['success'] and run3['success']:
+            if run['success']:
                 print "Done running chef-client"
             else:
                 print "Error running chef client to set network interfaces"
-                print "First run: %s" % run1
-                print "Second run: %s" % run2
-                print "Final run: %s" % run3
+                for index, chef_run in enumerate(run['runs']):
+                    print "Run %s: %s" % (index + 1, chef_run)
 
     def set_node_in_use(self, node, role):
         # Edit the controller in our chef
@@ -1307,7 +1549,7 @@ class rpcsqa_helper:
             # print message for debugging
             print "%s/knife.rb successfully saved" % chef_file_path
 
-        env = Environment(chef_environment)
+        env = Environment(chef_environment, api=self.chef)
         pem_file_name = "%s/admin.pem" % chef_file_path
         try:
             pem_file = open(pem_file_name)
@@ -1329,7 +1571,7 @@ class rpcsqa_helper:
         @summary Duplicates the local chef environment remotely
         """
         print "Putting environment onto remote chef server"
-        chef_environment = Environment(environment)
+        chef_environment = Environment(environment, api=self.chef)
         name = chef_environment.name
         remote_api = self.remote_chef_client(chef_environment)
         env = Environment(name, api=remote_api)
@@ -1463,7 +1705,7 @@ class rpcsqa_helper:
     def remote_chef_client(self, env):
         # RSAifying key
         print "Create chef client for env: %s" % env.name
-        env = Environment(env.name)
+        env = Environment(env.name, api=self.chef)
         remote_dict = dict(env.override_attributes['remote_chef'])
         pem = StringIO(remote_dict['key'])
         remote_dict['key'] = rsa.Key(pem)
@@ -1481,6 +1723,6 @@ class rpcsqa_helper:
                        "key": admin_pem,
                        "url": "https://%s:4443" %
                        chef_server_node['ipaddress']}
-        env = Environment(env)
+        env = Environment(env, api=self.chef)
         env.override_attributes['remote_chef'] = remote_dict
         env.save()
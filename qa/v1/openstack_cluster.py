@@ -100,7 +100,7 @@ if (results.branch in ["folsom"] or results.repo_tag in ["3.1.0", "4.0.0"]) and
     }]
 
     print "reverting to old network schema"
-    env_obj = Environment(env)
+    env_obj = Environment(env, api=rpcsqa.chef)
     env_obj.override_attributes['nova']['networks'] = old_networks
     env_obj.save()
 
@@ -112,7 +112,7 @@ if results.ha_enabled and results.neutron:
     quantum_network = {"ovs": {"network_type": "gre"}}
 
     print "Setting HA network to neutron"
-    env_obj = Environment(env)
+    env_obj = Environment(env, api=rpcsqa.chef)
 
     # Change the nova network attribute to be neutron
     env_obj.override_attributes['nova']['network'] = neutron_network
@@ -742,7 +742,7 @@ else:
             rpcsqa.build_controller(ha_controller_2, True, 2)
 
             # Have to run chef client on controller 1 again
-            ha_controller_1_node = Node(ha_controller_1)
+            ha_controller_1_node = Node(ha_controller_1, api=rpcsqa.chef)
             print "HA Setup...have to run chef client on %s again cause it is ha-controller1..." % ha_controller_1
             rpcsqa.run_chef_client(ha_controller_1_node)
 
@@ -0,0 +1,73 @@
+#!/usr/bin/python
+import json
+import argparse
+from modules.ring_planner import ring_planner
+
+# Parse arguments from the cmd line
+parser = argparse.ArgumentParser()
+parser.add_argument('--inventory', action="store", dest="inventory",
+                    required=False, default=None,
+                    help="JSON list of storage nodes, i.e. "
+                    "[{\"ip\": \"10.0.0.1\", \"disks\": {\"sdb1\": 1000}}]")
+
+parser.add_argument('--nodes', action="store", dest="nodes", type=int,
+                    required=False, default=3,
+                    help="Number of storage nodes, without an inventory")
+
+parser.add_argument('--disks', action="store", dest="disks", type=int,
+                    required=False, default=1,
+                    help="Disks per storage node, without an inventory")
+
+parser.add_argument('--disk_weight', action="store", dest="disk_weight",
+                    type=int, required=False, default=1000,
+                    help="Weight of each disk, without an inventory")
+
+parser.add_argument('--num_rings', action="store", dest="num_rings",
+                    type=int, required=False, default=3,
+                    help="Number of zones to spread the nodes over")
+
+parser.add_argument('--part_power', action="store", dest="part_power",
+                    type=int, required=False, default=10,
+                    help="Power of 2 partitions in the ring")
+
+parser.add_argument('--replicas', action="store", dest="replicas", type=int,
+                    required=False, default=3,
+                    help="Copies of each partition")
+
+parser.add_argument('--suggest', action="store_true", dest="suggest",
+                    required=False, default=False,
+                    help="Compare other zone counts and partition powers")
+
+# Save the parsed arguments
+results = parser.parse_args()
+
+if results.inventory:
+    with open(results.inventory) as f:
+        inventory = json.load(f)
+else:
+    inventory = [{"ip": "node{0}".format(n + 1),
+                  "disks": dict(("sd{0}1".format(chr(ord('b') + d)),
+                                 results.disk_weight)
+                                for d in xrange(results.disks))}
+                 for n in xrange(results.nodes)]
+
+planner = ring_planner.from_inventory(inventory,
+                                      zones=results.num_rings,
+                                      part_power=results.part_power,
+                                      replicas=results.replicas)
+print planner.report()
+
+if results.suggest:
+    suggestion = ring_planner.suggest(planner.devices, results.replicas)
+    part_powers = sorted(set([results.part_power,
+                              suggestion['part_power']]))
+    print
+    print "zones part_power balance zone_coverage lost_with_zone"
+    for zones in xrange(1, len(inventory) + 1):
+        for part_power in part_powers:
+            stats = ring_planner.from_inventory(
+                inventory, zones=zones, part_power=part_power,
+                replicas=suggestion['replicas']).simulate()
+            print "{0:5} {1:10} {2:6.2f}% {3:12.1f}% {4:14}".format(
+                zones, part_power, stats['balance'],
+                stats['zone_coverage'], stats['lost_with_zone'])
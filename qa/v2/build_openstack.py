@@ -183,6 +183,7 @@ def main():
                               'ip': node['ipaddress'],
                               'in_use': 'ha_controller2',
                               'run_list': ['role[ha-controller2]']})
+                controllers = ['ha_controller1', 'ha_controller2']
             else:
                 pre_commands = [{'function': qa.prepare_cinder, 'kwargs': {'node': node, 'api': api}}]
                 node = qa.get_razor_node(args.os_distro, env)
@@ -191,6 +192,7 @@ def main():
                               'in_use': 'single-controller',
                               'pre_commands': pre_commands,
                               'run_list': ['role[ha-controller1]', 'role[cinder-all]']})
+                controllers = ['single-controller']
 
 
             #Compute with whatever is left
@@ -200,6 +202,7 @@ def main():
                 build.append({'name':  node.name,
                               'ip': node['ipaddress'],
                               'in_use': 'single-compute',
+                              'requires': controllers,
                               'run_list': ['role[single-compute]']})
                 num_computes += 1
 
@@ -220,47 +223,84 @@ def main():
                                                    default=lambda o: o.__name__)
         print "#" * 70
         success = True
-        environment = Environment(env)
-        api = qa.chef
-        try:
-
-            for b in build:
-                print "#" * 70
-                print "Building: %s" % b
-                node = Node(b['name'])
+        environment = Environment(env, api=qa.chef)
+
+        def build_node(b):
+            print "#" * 70
+            print "Building: %s" % b
+            api = qa.chef
+            node = Node(b['name'], api=api)
+            node.chef_environment = env
+            node['in_use'] = b['in_use']
+            node.save()
+
+            if args.remote_chef and not b['in_use'] in ["chef_server","openldap"]:
+                qa.remove_chef(node)
+                query = "chef_environment:%s AND in_use:chef_server" % env
+                chef_server = next(qa.node_search(query))
+                qa.bootstrap_chef(node, chef_server)
+                api = qa.remote_chef_client(environment)
+                print "api: %s" % api.url
+
+            if 'pre_commands' in b:
+                _run_commands(qa, node, b['pre_commands'])
+
+            if 'run_list' in b:
+                # Reacquires node if using remote chef
+                node = Node(node.name, api=api)
+                node.run_list = b['run_list']
                 node.chef_environment = env
-                node['in_use'] = b['in_use']
                 node.save()
+                print "Running chef client for %s" % node
+                print node.run_list
+                chef_client = qa.run_chef_client(node,
+                                                 num_times=2,
+                                                 log_level=args.log_level)
+                if not chef_client['success']:
+                    print "chef-client run failed on %s" % node
+                    return False
+
+            if 'post_commands' in b:
+                _run_commands(qa, node, b['post_commands'])
+            return True
+
+        def build_order(build):
+            """
+            Groups builds into waves where every build only needs builds in
+            earlier waves. Builds that name no requires keep their place in
+            the serial order and wait for every build listed before them.
+            Within a wave builds stay in the order of build.
+            """
+            deps = []
+            for index, b in enumerate(build):
+                if 'requires' in b:
+                    deps.append([i for i, other in enumerate(build)
+                                 if other['in_use'] in b['requires']])
+                else:
+                    deps.append(range(index))
+            built = []
+            waves = []
+            remaining = range(len(build))
+            while remaining:
+                wave = [i for i in remaining
+                        if all(dep in built for dep in deps[i])]
+                if not wave:
+                    raise Exception("Circular build dependencies: {0}".format(
+                        ", ".join(build[i]['name'] for i in remaining)))
+                waves.append([build[i] for i in wave])
+                built.extend(wave)
+                remaining = [i for i in remaining if i not in wave]
+            return waves
 
-                if args.remote_chef and not b['in_use'] in ["chef_server","openldap"]:
-                    qa.remove_chef(node)
-                    query = "chef_environment:%s AND in_use:chef_server" % env
-                    chef_server = next(qa.node_search(query))
-                    qa.bootstrap_chef(node, chef_server)
-                    api = qa.remote_chef_client(environment)
-                    print "api: %s" % api.url
-
-                if 'pre_commands' in b:
-                    _run_commands(qa, node, b['pre_commands'])
-
-                if 'run_list' in b:
-                    # Reacquires node if using remote chef
-                    node = Node(node.name, api=api)
-                    node.run_list = b['run_list']
-                    node.chef_environment = env
-                    node.save()
-                    print "Running chef client for %s" % node
-                    print node.run_list
-                    chef_client = qa.run_chef_client(node,
-                                                     num_times=2,
-                                                     log_level=args.log_level)
-                    if not chef_client['success']:
-                        print "chef-client run failed"
+        try:
+            for wave in build_order(build):
+                for b, built, error in qa.run_on_nodes(build_node, wave):
+                    if error is not None:
+                        raise error
+                    if not built:
                         success = False
-                        break
-
-                if 'post_commands' in b:
-                    _run_commands(qa, node, b['post_commands'])
+                if not success:
+                    break
 
         except Exception, e:
             print traceback.print_exc()
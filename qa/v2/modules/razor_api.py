@@ -1,15 +1,23 @@
+import os
 import json
 import requests
+from threading import Lock
 
 
 class razor_api:
 
-    def __init__(self, rzrip, rzrport='8026'):
+    def __init__(self, rzrip, rzrport='8026', cache_file=None):
         """ Initilizer for razor_api class"""
         self.ip = rzrip
         self.port = rzrport
         self.url = 'http://' + rzrip + ':' + rzrport + '/razor/api'
 
+        # Active model passwords never change for the life of the model,
+        # keep them (optionally on disk for later steps of the same build)
+        self.cache_file = cache_file or os.environ.get('RAZOR_AM_CACHE')
+        self.cache_lock = Lock()
+        self.am_cache = self.load_am_cache()
+
     def __repr__(self):
         """ Print out current instnace of razor_api"""
         outl = 'class: ' + self.__class__.__name__
@@ -293,6 +301,7 @@ class razor_api:
         headers = {'content-type': 'application/json'}
         r = requests.delete(
             self.url + '/active_model/%s' % am_uuid, headers=headers)
+        self.forget_active_model(am_uuid)
 
         return {'status': r.status_code, 'content': json.loads(r.content)}
 
@@ -309,6 +318,10 @@ class razor_api:
 
     def get_active_model_pass(self, am_uuid):
         """ This function will get an active models password """
+        cached = self.am_cache.get(am_uuid)
+        if cached is not None:
+            return {'status_code': 200, 'password': cached['password']}
+
         headers = {'content-type': 'application/json'}
         r = requests.get(
             self.url + '/active_model/%s' % am_uuid, headers=headers)
@@ -316,6 +329,62 @@ class razor_api:
         passwd = ''
         if r.status_code == 200:
             content_json = json.loads(r.content)
-            passwd = content_json['response'][0]['@model']['@root_password']
+            response = content_json['response'][0]
+            model = response['@model']
+            passwd = model['@root_password']
+            self.cache_active_model(am_uuid,
+                                    {'password': passwd,
+                                     'node_uuid': response.get('@node_uuid'),
+                                     'hostname_prefix':
+                                     model.get('@hostname_prefix'),
+                                     'domain': model.get('@domainname')})
 
         return {'status_code': r.status_code, 'password': passwd}
+
+    def get_active_model_metadata(self, am_uuid):
+        """
+        This function will return the cached password, node uuid and
+        naming info of an active model, fetching it if needed
+        """
+        if am_uuid not in self.am_cache:
+            self.get_active_model_pass(am_uuid)
+        return self.am_cache.get(am_uuid)
+
+    def cache_active_model(self, am_uuid, metadata):
+        """ Remembers an active models metadata """
+        with self.cache_lock:
+            self.am_cache[am_uuid] = metadata
+            self.save_am_cache()
+
+    def forget_active_model(self, am_uuid):
+        """ Drops an active model from the cache """
+        with self.cache_lock:
+            if self.am_cache.pop(am_uuid, None) is not None:
+                self.save_am_cache()
+
+    def load_am_cache(self):
+        """ Loads the active model cache file if there is one """
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return {}
+        try:
+            # It holds root passwords, so only a private one of ours is used
+            st = os.stat(self.cache_file)
+            if st.st_uid != os.getuid() or st.st_mode & 0077:
+                return {}
+            with open(self.cache_file) as f:
+                return json.load(f)
+        except (OSError, IOError, ValueError):
+            # A broken cache only costs us the lookups
+            return {}
+
+    def save_am_cache(self):
+        """ Writes the active model cache file if one is configured """
+        if not self.cache_file:
+            return
+        tmp_file = "%s.%s" % (self.cache_file, os.getpid())
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        # A stale temp file left by a reused pid keeps its old mode
+        os.fchmod(fd, 0600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.am_cache, f)
+        os.rename(tmp_file, self.cache_file)
@@ -1,22 +1,75 @@
+import re
 import sys
 import time
+import random
 import itertools
 from chef import *
 import environments
 from glob import glob
+from threading import Lock, RLock
 from server_helper import *
+from lease_helper import lease_helper
 from modules.Config import Config
 from modules.razor_api import razor_api
 from xml.etree import ElementTree
 
 
-class rpcsqa_helper:
+class rpcsqa_helper(object):
 
-    def __init__(self):
-        self.config = Config()
-        self.razor = razor_api(self.config['razor']['ip'])
+    # One helper per razor server for the life of the process
+    instances = {}
+    instances_lock = Lock()
+
+    def __new__(cls, razor_ip=None):
+        with cls.instances_lock:
+            if razor_ip not in cls.instances:
+                helper = super(rpcsqa_helper, cls).__new__(cls)
+                helper.setup(razor_ip)
+                cls.instances[razor_ip] = helper
+            return cls.instances[razor_ip]
+
+    def __init__(self, razor_ip=None):
+        # The shared instance was already set up by __new__
+        pass
+
+    def setup(self, razor_ip):
+        """
+        Clients and config are only loaded the first time they are used, so
+        scripts that never touch them start straight away. The chef api is
+        the exception: pychef keeps its default api per thread, so it is set
+        here on the constructing thread rather than on whichever worker
+        happens to use it first
+        """
+        self.razor_ip = razor_ip
+        self.lock = RLock()
+        self._config = None
+        self._razor = None
         self.chef = autoconfigure()
+        # Chef objects built without an api fall back to this one
         self.chef.set_default()
+        self._leases = None
+
+    @property
+    def config(self):
+        with self.lock:
+            if self._config is None:
+                self._config = Config()
+        return self._config
+
+    @property
+    def razor(self):
+        with self.lock:
+            if self._razor is None:
+                ip = self.razor_ip or self.config['razor']['ip']
+                self._razor = razor_api(ip)
+        return self._razor
+
+    @property
+    def leases(self):
+        with self.lock:
+            if self._leases is None:
+                self._leases = lease_helper(self.chef)
+        return self._leases
 
     def enable_public_cloud(self, username, api_key):
         import pyrax
@@ -92,16 +145,17 @@ class rpcsqa_helper:
     def delete_environment(self, chef_environment):
         Environment(chef_environment, api=self.chef).delete()
 
-    def cleanup_environment(self, chef_environment):
+    def cleanup_environment(self, chef_environment, wait=False):
         """ Rekick nodes previously in use and reuse clean nodes. """
         query = "chef_environment:%s" % chef_environment
-        nodes = self.node_search(query)
-        for n in nodes:
+        dirty = []
+        for n in self.node_search(query):
             if n['in_use'] != 0:
-                self.erase_node(n)
+                dirty.append(n)
             else:
                 n.chef_environment = "_default"
                 n.save()
+        return self.erase_nodes(dirty, wait=wait)
 
     def run_command_on_node(self, node, command, num_times=1, quiet=False,
                             private=False):
@@ -126,44 +180,168 @@ class rpcsqa_helper:
                 return addr
 
     def run_chef_client(self, chef_node, num_times=1, log_level='error',
-                        quiet=False):
-        # log level can be (debug, info, warn, error, fatal)
-        return self.run_command_on_node(chef_node,
-                                        'chef-client -l %s' % log_level,
-                                        num_times,
-                                        quiet)
+                        quiet=False, converge=True):
+        """
+        Runs chef-client up to num_times, only running it again while the
+        last run failed or updated resources
+        @param converge: Stop once converged, or always run num_times
+        @type converge: Boolean
+        @return Dict of success, whether the node converged and the runs,
+                each with its 'seconds' and 'updated' resources (None if
+                chef didn't say)
+        """
+        # log level can be (debug, info, warn, error, fatal), the formatter
+        # is forced so the resources updated summary prints without a tty
+        command = 'chef-client --force-formatter -l %s' % log_level
+        runs = []
+        for i in xrange(0, num_times):
+            start = time.time()
+            run = self.run_command_on_node(chef_node, command,
+                                           quiet=quiet)['runs'][0]
+            run['seconds'] = time.time() - start
+            run['updated'] = self.updated_resources(run)
+            runs.append(run)
+            updated = "unknown" if run['updated'] is None else run['updated']
+            print "chef-client run {0} on {1}: {2} resources updated in " \
+                "{3:.0f}s".format(i + 1, chef_node.name, updated,
+                                  run['seconds'])
+            if converge and run['success'] and run['updated'] == 0:
+                break
+        last = runs[-1]
+        if converge:
+            success = last['success']
+        else:
+            success = all(run['success'] for run in runs)
+        return {'success': success,
+                'converged': last['success'] and last['updated'] == 0,
+                'runs': runs}
+
+    # Chef's summary line, i.e. "Chef Client finished, 3/120 resources
+    # updated" or "3 resources updated"
+    updated_pattern = re.compile(r'(\d+)(?:/\d+)? resources updated')
+
+    def updated_resources(self, run):
+        """
+        Gets how many resources a chef-client run updated from its summary
+        @return Integer, or None when the output has no summary
+        """
+        counts = self.updated_pattern.findall(run['return'])
+        if counts:
+            return int(counts[-1])
+        return None
+
+    def run_command_on_environment(self, query, command, num_times=1,
+                                   quiet=False, private=False, max_workers=10):
+        """
+        Runs command on every node matching a chef search at once
+        @param query: Chef node search, i.e. "chef_environment:foo"
+        @type query: String
+        @param command: Command to run on each node
+        @type command: String
+        @param max_workers: Most nodes to run on at the same time
+        @type max_workers: Integer
+        @return Dict of node name to run_command_on_node result
+        """
+        nodes = self.node_search(query)
+        return self.run_command_on_nodes(nodes, command, num_times, quiet,
+                                         private, max_workers)
+
+    def run_command_on_nodes(self, nodes, command, num_times=1, quiet=False,
+                             private=False, max_workers=10):
+        """
+        Runs command on a list of chef nodes at once
+        @return Dict of node name to run_command_on_node result
+        """
+        run = lambda node: self.run_command_on_node(node, command, num_times,
+                                                    quiet, private)
+        results = {}
+        for node, ret, error in self.run_on_nodes(run, nodes, max_workers):
+            if error is not None:
+                ret = {'success': False,
+                       'runs': [{'success': False,
+                                 'return': "",
+                                 'exit_status': -1,
+                                 'error': str(error)}]}
+            results[node.name] = ret
+        return results
+
+    def run_on_nodes(self, func, nodes, max_workers=10):
+        """
+        Fans func out over nodes with this helpers chef api as the default
+        in every worker thread
+        @return list of (node, result, exception)
+        """
+        def run(node):
+            with self.chef:
+                return func(node)
+        return run_parallel(run, nodes, max_workers)
 
     def interface_physical_nodes(self, os):
         #Make sure all network interfacing is set
         query = "name:*%s*" % os
-        for node in self.node_search(query):
-            if "role[qa-base]" in node.run_list:
-                node.run_list = ["recipe[network-interfaces]"]
-                node['in_use'] = 0
-                node.save()
-                print "Running network interfaces for %s" % node
-                #Run chef client thrice
-                run_chef_client = self.run_chef_client(node,
-                                                       num_times=3,
-                                                       quiet=True)
-                if run_chef_client['success']:
-                    print "Done running chef-client"
-                else:
-                    for index, run in enumerate(run_chef_client['runs']):
-                        print "Run %s: %s" % (index+1, run)
+        nodes = [node for node in self.node_search(query)
+                 if "role[qa-base]" in node.run_list]
+        for node in nodes:
+            node.run_list = ["recipe[network-interfaces]"]
+            node['in_use'] = 0
+            node.save()
+            print "Running network interfaces for %s" % node
+
+        #Run chef client until converged, at most thrice
+        runs = self.run_on_nodes(
+            lambda node: self.run_chef_client(node, num_times=3, quiet=True),
+            nodes)
+        for node, run_chef_client, error in runs:
+            if error is not None:
+                print "Error running chef-client on %s: %s" % (node, error)
+            elif run_chef_client['success']:
+                print "Done running chef-client on %s" % node
+            else:
+                for index, run in enumerate(run_chef_client['runs']):
+                    print "Run %s: %s" % (index+1, run)
 
     def get_razor_node(self, os, environment):
+        return self.get_razor_nodes(os, environment)[0]
+
+    def get_razor_nodes(self, os, environment, count=1):
+        """
+        Claims count free pool nodes for environment. Nodes are leased
+        while being moved so concurrent builds never grab the same one.
+        """
         nodes = self.node_search("name:qa-%s-pool*" % os)
-        # Take a node from the default environment that has its network interfaces set.
-        for node in nodes:
-            is_default = node.chef_environment == "_default"
-            iface_in_run_list = "recipe[network-interfaces]" in node.run_list
-            if (is_default and iface_in_run_list):
-                node.chef_environment = environment
-                node['in_use'] = 0
+        # Take nodes from the default environment that have their network interfaces set.
+        free = [node.name for node in nodes
+                if node.chef_environment == "_default" and
+                "recipe[network-interfaces]" in node.run_list]
+        claimed = []
+        try:
+            while len(claimed) < count:
+                names = self.leases.claim(free, count - len(claimed))
+                if not names:
+                    break
+                free = [name for name in free if name not in names]
+                try:
+                    for name in names:
+                        # The search index lags, make sure nobody beat us to it
+                        node = Node(name, api=self.chef)
+                        if node.chef_environment != "_default":
+                            continue
+                        node.chef_environment = environment
+                        node['in_use'] = 0
+                        node.save()
+                        claimed.append(node)
+                finally:
+                    self.leases.release(names)
+            if len(claimed) < count:
+                raise Exception("No more nodes!!")
+        except Exception:
+            # Hand back the nodes already moved rather than strand them
+            for node in claimed:
+                print "Returning node {0} to the pool".format(node.name)
+                node.chef_environment = "_default"
                 node.save()
-                return node
-        raise Exception("No more nodes!!")
+            raise
+        return claimed
 
     def remove_broker_fail(self, policy):
         active_models = self.razor.simple_active_models(policy)
@@ -174,10 +352,10 @@ class rpcsqa_helper:
                 user_pass = self.razor.get_active_model_pass(
                     data['am_uuid'])['password']
                 ip = data['eth1_ip']
-                run = ssh_cmd(ip, 'root', user_pass, 'reboot 0')
+                run = ssh_cmd(ip, 'reboot 0', 'root', user_pass)
                 if run['success']:
+                    pool.discard(ip)
                     self.razor.remove_active_model(data['am_uuid'])
-                    time.sleep(15)
                 else:
                     print "!!## -- Trouble removing broker fail -- ##!!"
                     print run
@@ -185,15 +363,81 @@ class rpcsqa_helper:
     def erase_node(self, chef_node):
         print "Deleting: %s" % str(chef_node)
         am_uuid = chef_node['razor_metadata']['razor_active_model_uuid']
-        run = ssh_cmd(chef_node['ipaddress'], 'root', self.razor_password(chef_node), "reboot 0", quiet=True)
+        ip = chef_node['ipaddress']
+        run = self.run_command_on_node(chef_node, "reboot 0", quiet=True)
         if not run['success']:
-            raise Exception("Error rebooting server %s@%s " % (chef_node, chef_node['ipaddress']))
+            raise Exception("Error rebooting server %s@%s " % (chef_node, ip))
+        # The reboot takes the pooled ssh connection down with it
+        pool.discard(ip)
         #Knife node remove; knife client remove
-        Client(str(chef_node)).delete()
+        Client(str(chef_node), api=self.chef).delete()
         chef_node.delete()
         #Remove active model
         self.razor.remove_active_model(am_uuid)
-        time.sleep(15)
+
+    def erase_nodes(self, chef_nodes, wait=True, timeout=1800, interval=30):
+        """
+        Erases nodes concurrently. Unless wait is False, then polls razor
+        until each node is bound to a new active model and brokered back
+        into the pool. The rekicked box comes back under a new chef name, so
+        it is tracked by its razor node uuid.
+        @param wait: Block until the nodes are back, or fire and forget
+        @type wait: Boolean
+        @param timeout: Seconds to wait for nodes to come back
+        @type timeout: Integer
+        @return Dict of node name to {'erased', 'error', 'returned',
+                'seconds'}, returned is None when not waited on
+        """
+        # Look the razor node up first, removing the active model drops it
+        # from the cache
+        razor_nodes = {}
+        for chef_node in chef_nodes:
+            am_uuid = chef_node['razor_metadata']['razor_active_model_uuid']
+            metadata = self.razor.get_active_model_metadata(am_uuid) or {}
+            razor_nodes[chef_node.name] = (am_uuid, metadata.get('node_uuid'))
+
+        start = time.time()
+        report = {}
+        for node, ret, error in self.run_on_nodes(self.erase_node,
+                                                  chef_nodes):
+            report[node.name] = {'erased': error is None,
+                                 'error': None if error is None
+                                 else str(error),
+                                 'returned': None,
+                                 'seconds': None}
+        pending = set(name for name in report
+                      if report[name]['erased'] and razor_nodes[name][1])
+        while wait and pending and time.time() - start < timeout:
+            time.sleep(interval)
+            active_models = self.razor.simple_active_models()
+            if not isinstance(active_models, dict):
+                continue
+            for name in list(pending):
+                am_uuid, node_uuid = razor_nodes[name]
+                # The node is back once razor has bound it to a new active
+                # model and its broker has run
+                if any(am['node_uuid'] == node_uuid and
+                       am['am_uuid'] != am_uuid and
+                       ('broker_success' in am['current_state'] or
+                        'complete' in am['current_state'])
+                       for am in active_models.values()):
+                    report[name]['returned'] = True
+                    report[name]['seconds'] = int(time.time() - start)
+                    pending.discard(name)
+        if wait:
+            for name in pending:
+                report[name]['returned'] = False
+
+        failed = []
+        for name, status in sorted(report.items()):
+            if not status['erased']:
+                print "Failed to erase %s: %s" % (name, status['error'])
+                failed.append(name)
+            elif status['returned'] is False:
+                print "%s has not returned to the pool" % name
+        if failed:
+            raise Exception("Failed to erase %s" % ", ".join(failed))
+        return report
 
     def get_environment_nodes(self, environment='', api=None):
         """Returns all the nodes of an environment"""
@@ -203,7 +447,10 @@ class rpcsqa_helper:
 
     def razor_password(self, chef_node):
         try:
-            chef_node = Node(chef_node.name, api=self.chef)
+            # Only refetch nodes that didn't come with razor's metadata,
+            # i.e. ones loaded from a remote chef server
+            if 'razor_metadata' not in chef_node.attributes:
+                chef_node = Node(chef_node.name, api=self.chef)
             uuid = chef_node.attributes['razor_metadata']['razor_active_model_uuid']
         except:
             print dict(chef_node.attributes)
@@ -212,19 +459,43 @@ class rpcsqa_helper:
 
     def remote_chef_client(self, env):
         # RSAifying key
-        env = Environment(env)
+        env = Environment(env, api=self.chef)
         remote_dict = dict(env.override_attributes['remote_chef'])
         return ChefAPI(**remote_dict)
 
-    def node_search(self, query=None, api=None, tries=10):
+    def node_search(self, query=None, api=None, tries=10, backoff=1):
+        """
+        Searches chef for nodes. Returns as soon as something matches,
+        only retrying with exponential backoff and jitter while the
+        search comes back empty (solr can lag a save by several seconds)
+        @param tries: Number of searches before giving up
+        @type tries: Integer
+        @param backoff: Seconds to wait before the first retry
+        @type backoff: Float
+        """
         api = api or self.chef
-        search = None
-        while not search and tries > 0:
+        delay = backoff
+        search = []
+        for attempt in xrange(tries):
             search = Search("node", api=api).query(query)
-            time.sleep(10)
-            tries = tries - 1
+            if search or attempt == tries - 1:
+                break
+            time.sleep(delay + random.uniform(0, delay))
+            delay = min(delay * 2, 30)
         return (n.object for n in search)
 
+    def wait_for_indexed(self, name, attribute=None, value=None, api=None,
+                         tries=10):
+        """
+        Waits until a node, and optionally one of its attributes, is
+        visible to search, i.e. right after saving it
+        @return The node or None if it never showed up
+        """
+        query = "name:%s" % name
+        if attribute:
+            query = "%s AND %s:%s" % (query, attribute, value)
+        return next(self.node_search(query, api, tries), None)
+
     # Make these use run_command_on_node
     def scp_from_node(self, node=None, path=None, destination=None):
         user = "root"
@@ -236,7 +507,7 @@ class rpcsqa_helper:
         user = "root"
         password = self.razor_password(node)
         ip = node['ipaddress']
-        return run_remote_scp_cmd(ip, user, password, path)
+        return scp_to(ip, path, user, password)
 
 
     def disable_controller(self, node):
@@ -359,7 +630,7 @@ class rpcsqa_helper:
                                self.config['rcbops']['git']['url'],
                                branch)
         if env:
-            chef_env = Environment(env)
+            chef_env = Environment(env, api=self.chef)
             self.add_remote_chef_locally(chef_node, chef_env)
             self.setup_remote_chef_environment(chef_env)
             if api:
@@ -388,7 +659,7 @@ class rpcsqa_helper:
         """
         @param chef_node
         """
-        chef_node = Node(name)
+        chef_node = Node(name, api=self.chef)
         print "removing chef on %s..." % chef_node
         if chef_node['platform_family'] == "debian":
             command = "apt-get remove --purge -y chef; rm -rf /etc/chef"
@@ -498,12 +769,12 @@ class rpcsqa_helper:
         '''
 
         # install chef client and bootstrap
-        client_node = Node(name)
+        client_node = Node(name, api=self.chef)
         chef_client_ip = client_node['ipaddress']
         chef_client_password = self.razor_password(client_node)
         cmd = 'knife bootstrap %s -x root -P %s' % (chef_client_ip,
                                                     chef_client_password)
-        ssh_run = self.run_command_on_node(Node(server_node), cmd)
+        ssh_run = self.run_command_on_node(Node(server_node, api=self.chef), cmd)
 
         if ssh_run['success']:
             print "Successfully bootstraped chef-client on %s to chef-server on %s" % (client_node, server_node)
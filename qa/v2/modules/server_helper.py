@@ -1,9 +1,118 @@
+import os
 import sys
-from cStringIO import StringIO
-from paramiko import SSHClient, AutoAddPolicy
+import time
+import atexit
+import posixpath
+from glob import glob, has_magic
+from stat import S_ISDIR
+from select import select
+from fnmatch import fnmatch
+from threading import Lock
+from collections import deque
+from multiprocessing.pool import ThreadPool
+from paramiko import SSHClient, AutoAddPolicy, SSHException
 from subprocess import check_call, CalledProcessError
 
 
+class ssh_pool(object):
+    """
+    Keeps authenticated ssh connections open per host so repeated
+    commands against the same node reuse one transport
+    """
+
+    def __init__(self, idle_timeout=300):
+        self.idle_timeout = idle_timeout
+        self.clients = {}
+        self.lock = Lock()
+
+    def __repr__(self):
+        """ Print out current instance
+        """
+        outl = 'class: ' + self.__class__.__name__
+        for key in self.clients:
+            outl += '\n\t{0}@{1}'.format(key[1], key[0])
+        return outl
+
+    def get(self, ip, user='root', password=None):
+        """
+        Returns a connected client for ip/user, reconnecting if the cached
+        transport went away, went idle or the password changed
+        @param ip
+        @param user
+        @param password
+        @return paramiko.SSHClient
+        """
+        key = (ip, user)
+        with self.lock:
+            self._reap()
+            entry = self.clients.get(key)
+            if entry and entry['password'] == password and \
+                    self._healthy(entry['client']):
+                entry['last_used'] = time.time()
+                return entry['client']
+            self._close(key)
+
+        client = SSHClient()
+        client.set_missing_host_key_policy(AutoAddPolicy())
+        client.connect(ip, username=user, password=password)
+
+        with self.lock:
+            # Another thread may have connected in the mean time, keep its
+            # client as it may already be running commands on it
+            entry = self.clients.get(key)
+            if entry and entry['password'] == password and \
+                    self._healthy(entry['client']):
+                entry['last_used'] = time.time()
+                existing = entry['client']
+            else:
+                existing = None
+                self._close(key)
+                self.clients[key] = {'client': client,
+                                     'password': password,
+                                     'last_used': time.time()}
+        if existing is not None:
+            client.close()
+            return existing
+        return client
+
+    def discard(self, ip, user='root'):
+        """
+        Drops a cached connection, i.e. after rebooting the host
+        """
+        with self.lock:
+            self._close((ip, user))
+
+    def close_all(self):
+        with self.lock:
+            for key in self.clients.keys():
+                self._close(key)
+
+    def _healthy(self, client):
+        transport = client.get_transport()
+        if transport is None or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except (SSHException, EOFError, IOError):
+            return False
+        return True
+
+    def _reap(self):
+        now = time.time()
+        for key, entry in self.clients.items():
+            if now - entry['last_used'] > self.idle_timeout:
+                self._close(key)
+
+    def _close(self, key):
+        entry = self.clients.pop(key, None)
+        if entry:
+            entry['client'].close()
+
+# Shared by every caller of ssh_cmd in this process
+pool = ssh_pool()
+atexit.register(pool.close_all)
+
+
 def run_cmd(command):
     """
     @param cmd
@@ -19,83 +128,322 @@ def run_cmd(command):
                 'command': command}
 
 
-def ssh_cmd(ip, remote_cmd, user='root', password=None, quiet=False):
+def run_parallel(func, items, max_workers=10):
+    """
+    Calls func on each item from a bounded pool of threads
+    @param func callable taking a single item
+    @param items iterable of items to fan out over
+    @param max_workers most calls in flight at once
+    @return list of (item, result, exception) in the order of items
+    """
+    items = list(items)
+    if not items:
+        return []
+
+    def call(item):
+        # sys.exit in a worker would kill the thread and hang the pool,
+        # so hand everything back to the caller to deal with
+        try:
+            return func(item), None
+        except BaseException, e:
+            return None, e
+
+    workers = ThreadPool(min(max_workers, len(items)))
+    try:
+        results = workers.map(call, items)
+    finally:
+        workers.close()
+        workers.join()
+    return [(item, result, error)
+            for item, (result, error) in zip(items, results)]
+
+
+class ring_buffer(object):
+    """
+    Keeps only the last size bytes written to it
+    """
+
+    def __init__(self, size=65536):
+        self.size = size
+        self.chunks = deque()
+        self.length = 0
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.length += len(data)
+        while self.length - len(self.chunks[0]) >= self.size:
+            self.length -= len(self.chunks.popleft())
+
+    def getvalue(self):
+        return ''.join(self.chunks)[-self.size:]
+
+
+def stream_channel(chan, output, error, quiet=False, log=None,
+                   callback=None, bufsize=32768):
+    """
+    Drains stdout and stderr of a running command together, so a command
+    filling one never stalls waiting on a reader stuck on the other
+    @param chan paramiko channel the command was started on
+    @param output file like object stdout is kept in
+    @param error file like object stderr is kept in
+    @param quiet don't echo stdout to the console
+    @param log file like object both streams are teed into
+    @param callback called with ('stdout' or 'stderr', data) per chunk
+    @return exit status of the command
+    """
+    def emit(name, data, sink, echo):
+        sink.write(data)
+        if echo:
+            sys.stdout.write(data)
+        if log is not None:
+            log.write(data)
+        if callback is not None:
+            callback(name, data)
+
+    while True:
+        select([chan], [], [], 1)
+        while chan.recv_ready():
+            emit('stdout', chan.recv(bufsize), output, not quiet)
+        while chan.recv_stderr_ready():
+            emit('stderr', chan.recv_stderr(bufsize), error, True)
+        # Data always arrives ahead of the exit status, so once it is in
+        # and both streams are empty there is nothing left to read
+        if (chan.exit_status_ready() and not chan.recv_ready() and
+                not chan.recv_stderr_ready()):
+            break
+    return chan.recv_exit_status()
+
+
+def ssh_cmd(ip, remote_cmd, user='root', password=None, quiet=False,
+            log=None, callback=None, keep=65536):
     """
     @param server_ip
     @param user
     @param password
     @param remote_cmd
+    @param log file like object output is teed into as it arrives
+    @param callback called with ('stdout' or 'stderr', data) per chunk
+    @param keep bytes of each stream kept for the returned map
     @return A map based on pass / fail run info
     """
-    output = StringIO()
-    error = StringIO()
-    ssh = SSHClient()
-    ssh.set_missing_host_key_policy(AutoAddPolicy())
-    ssh.connect(ip, username=user, password=password)
-    stdin, stdout, stderr = ssh.exec_command(remote_cmd)
-    stdin.close()
-    exit_status = None
-    for line in stdout.xreadlines():
-        if not quiet:
-            sys.stdout.write(line)
-            output.write(line)
-    for line in stderr.xreadlines():
-        sys.stdout.write(line)
-        error.write(line)
-        exit_status = stdout.channel.recv_exit_status()
+    output = ring_buffer(keep)
+    error = ring_buffer(keep)
+    ssh = pool.get(ip, user=user, password=password)
+    try:
+        chan = ssh.get_transport().open_session()
+    except SSHException:
+        # Cached transport died between the health check and now
+        pool.discard(ip, user=user)
+        ssh = pool.get(ip, user=user, password=password)
+        chan = ssh.get_transport().open_session()
+    chan.exec_command(remote_cmd)
+    chan.shutdown_write()
+    exit_status = stream_channel(chan, output, error, quiet=quiet, log=log,
+                                 callback=callback)
+    chan.close()
     return {'success': True if exit_status == 0 else False,
             'return': output.getvalue(),
             'exit_status': exit_status,
             'error': error.getvalue()}
 
 
+def sftp_session(ip, user='root', password=None):
+    """
+    Opens an sftp session over the pooled connection to ip
+    """
+    ssh = pool.get(ip, user=user, password=password)
+    try:
+        return ssh.open_sftp()
+    except SSHException:
+        # Cached transport died between the health check and now
+        pool.discard(ip, user=user)
+        return pool.get(ip, user=user, password=password).open_sftp()
+
+
+def sftp_isdir(sftp, path):
+    try:
+        return S_ISDIR(sftp.stat(path).st_mode)
+    except IOError:
+        return False
+
+
+def sftp_glob(sftp, pattern):
+    """
+    Expands a remote glob, sftp paths are relative to the users home
+    """
+    if pattern == '~' or pattern.startswith('~/'):
+        pattern = pattern[2:] or '.'
+    if not has_magic(pattern):
+        return [pattern]
+    dirname, basename = posixpath.split(pattern)
+    if has_magic(dirname):
+        dirs = [d for d in sftp_glob(sftp, dirname) if sftp_isdir(sftp, d)]
+    else:
+        dirs = [dirname]
+    return sorted(posixpath.join(d, name)
+                  for d in dirs
+                  for name in sftp.listdir(d or '.')
+                  if fnmatch(name, basename))
+
+
+def sftp_walk(sftp, top):
+    """
+    Yields (directory, file names) for top and every directory below it
+    """
+    dirs = []
+    files = []
+    for attr in sftp.listdir_attr(top):
+        if S_ISDIR(attr.st_mode):
+            dirs.append(attr.filename)
+        else:
+            files.append(attr.filename)
+    yield top, files
+    for name in dirs:
+        for walked in sftp_walk(sftp, posixpath.join(top, name)):
+            yield walked
+
+
+def transfer_report(copied, size, start, exception=None):
+    """
+    @return A map based on pass / fail run info, including throughput
+    """
+    seconds = time.time() - start
+    rate = size / seconds if seconds else 0
+    print "Copied {0} files, {1} bytes in {2:.2f}s ({3:.0f} bytes/sec)".format(
+        len(copied), size, seconds, rate)
+    return {'success': exception is None,
+            'return': copied,
+            'bytes': size,
+            'seconds': seconds,
+            'rate': rate,
+            'exception': exception}
+
+
+def sftp_put(ip, local_paths, user='root', password=None, remote_path=""):
+    """
+    Copies local files, globs and directories to ip over a single sftp
+    session, writes are pipelined
+    @param local_paths path, glob or list of them to copy
+    @param remote_path directory, or the new name when copying one source;
+    defaults to the users home
+    @return A map based on pass / fail run info, return lists the remote
+    files written
+    """
+    if isinstance(local_paths, basestring):
+        local_paths = [local_paths]
+    start = time.time()
+    copied = []
+    size = 0
+    sftp = None
+    try:
+        sources = []
+        for pattern in local_paths:
+            sources.extend(sorted(glob(pattern)) or [pattern])
+        sftp = sftp_session(ip, user, password)
+        remote_path = remote_path or '.'
+        into = (len(sources) > 1 or remote_path.endswith('/') or
+                sftp_isdir(sftp, remote_path))
+        for source in sources:
+            source = source.rstrip('/')
+            if into:
+                target = posixpath.join(remote_path,
+                                        os.path.basename(source))
+            else:
+                target = remote_path
+            if not os.path.isdir(source):
+                sftp.put(source, target)
+                size += os.path.getsize(source)
+                copied.append(target)
+                continue
+            for root, dirs, files in os.walk(source):
+                rel = os.path.relpath(root, source)
+                rdir = posixpath.normpath(posixpath.join(
+                    target, *rel.split(os.sep)))
+                if not sftp_isdir(sftp, rdir):
+                    sftp.mkdir(rdir)
+                for name in files:
+                    sftp.put(os.path.join(root, name),
+                             posixpath.join(rdir, name))
+                    size += os.path.getsize(os.path.join(root, name))
+                    copied.append(posixpath.join(rdir, name))
+    except (IOError, OSError, SSHException), e:
+        return transfer_report(copied, size, start, e)
+    finally:
+        if sftp is not None:
+            sftp.close()
+    return transfer_report(copied, size, start)
+
+
+def sftp_get(ip, remote_paths, user='root', password=None, local_path=""):
+    """
+    Copies remote files, globs and directories from ip over a single sftp
+    session, reads are prefetched
+    @param remote_paths path, glob or list of them to copy
+    @param local_path directory, or the new name when copying one source;
+    defaults to the current directory
+    @return A map based on pass / fail run info, return lists the local
+    files written
+    """
+    if isinstance(remote_paths, basestring):
+        remote_paths = [remote_paths]
+    start = time.time()
+    copied = []
+    size = 0
+    sftp = None
+    try:
+        sftp = sftp_session(ip, user, password)
+        sources = []
+        for pattern in remote_paths:
+            sources.extend(sftp_glob(sftp, pattern))
+        local_path = local_path or '.'
+        into = (len(sources) > 1 or local_path.endswith('/') or
+                os.path.isdir(local_path))
+        if into and not os.path.isdir(local_path):
+            os.makedirs(local_path)
+        for source in sources:
+            source = source.rstrip('/')
+            if into:
+                target = os.path.join(local_path,
+                                      posixpath.basename(source))
+            else:
+                target = local_path
+            if not sftp_isdir(sftp, source):
+                sftp.get(source, target)
+                size += os.path.getsize(target)
+                copied.append(target)
+                continue
+            for root, files in sftp_walk(sftp, source):
+                rel = posixpath.relpath(root, source)
+                ldir = os.path.normpath(os.path.join(target,
+                                                     *rel.split('/')))
+                if not os.path.isdir(ldir):
+                    os.makedirs(ldir)
+                for name in files:
+                    sftp.get(posixpath.join(root, name),
+                             os.path.join(ldir, name))
+                    size += os.path.getsize(os.path.join(ldir, name))
+                    copied.append(os.path.join(ldir, name))
+    except (IOError, OSError, SSHException), e:
+        return transfer_report(copied, size, start, e)
+    finally:
+        if sftp is not None:
+            sftp.close()
+    return transfer_report(copied, size, start)
+
+
 def scp_to(ip, local_path, user='root', password=None, remote_path=""):
     """
     @param to_copy
     @return A map based on pass / fail run info
     """
-    command = ("sshpass -p %s scp "
-               "-o Self.UserKnownHostsFile=/dev/null "
-               "-o StrictHostKeyChecking=no "
-               "-o LogLevel=quiet "
-               "%s %s@%s:%s") % (password,
-                                 local_path,
-                                 user, ip,
-                                 remote_path)
-    try:
-        ret = check_call(command, shell=True)
-        return {'success': True,
-                'return': ret,
-                'exception': None}
-    except CalledProcessError, cpe:
-        return {'success': False,
-                'return': None,
-                'exception': cpe,
-                'command': command}
+    return sftp_put(ip, local_path, user=user, password=password,
+                    remote_path=remote_path)
 
 
-def scp_from(ip, remote_path, user=None, password=None, local_path=""):
+def scp_from(ip, remote_path, user='root', password=None, local_path=""):
     """
     @param path_to_file: file to copy
     @param copy_location: place on localhost to place file
     """
-
-    command = ("sshpass -p %s scp "
-               "-o Self.UserKnownHostsFile=/dev/null "
-               "-o StrictHostKeyChecking=no "
-               "-o LogLevel=quiet "
-               "%s@%s:%s %s") % (password,
-                                 user, ip,
-                                 remote_path,
-                                 local_path)
-
-    try:
-        ret = check_call(command, shell=True)
-        return {'success': True,
-                'return': ret,
-                'exception': None}
-    except CalledProcessError, cpe:
-        return {'success': False,
-                'return': None,
-                'exception': cpe,
-                'command': command}
+    return sftp_get(ip, remote_path, user=user, password=password,
+                    local_path=local_path)
@@ -197,60 +197,44 @@ def build(name='autotest', branch='grizzly', tag=None,
                             chef_config_file=config_file)
 
     #####################################################################
-    # Build Swift Proxy
+    # Build Swift Proxy and Object Storage Boxes
     #####################################################################
 
     print '#' * 60
-    print "############### Building Swift Proxy Nodes ##################"
+    print "########## Building Swift Proxy and Storage Nodes ###########"
     print '#' * 60
 
-    for proxy in swift_proxy:
-        # Make Swift Proxy Node
-        rpcsqa.set_node_in_use(proxy, swift_roles['proxy'])
-
-        # Need to prep centos boxes
-        if os_distro == 'centos':
-            rpcsqa.prepare_server(proxy)
-
-        # Remove Razor/Chef and bootstrap to new chef server
-        rpcsqa.remove_chef(proxy)
-        rpcsqa.bootstrap_chef(proxy, chef_server)
-
-        # Build Swift Proxy Node
-        rpcsqa.build_swift_node(proxy,
-                                swift_roles['proxy'],
-                                env,
-                                remote=remote_chef,
-                                chef_config_file=config_file)
+    def build_swift(swift_node):
+        name, role = swift_node
 
-    #####################################################################
-    # Build Swift Object Storage Boxes
-    #####################################################################
-
-    print '#' * 60
-    print "############## Building Swift Storage Nodes #################"
-    print '#' * 60
-
-    for node in swift_storage:
-
-        # Make Swift Proxy Node
-        rpcsqa.set_node_in_use(node, swift_roles['storage'])
+        # Make Swift Proxy / Storage Node
+        rpcsqa.set_node_in_use(name, role)
 
         # Need to prep centos boxes
         if os_distro == 'centos':
-            rpcsqa.prepare_server(node)
+            rpcsqa.prepare_server(name)
 
         # Remove Razor/Chef and bootstrap to new chef server
-        rpcsqa.remove_chef(node)
-        rpcsqa.bootstrap_chef(node, chef_server)
+        rpcsqa.remove_chef(name)
+        rpcsqa.bootstrap_chef(name, chef_server)
 
-        # Build Swift Proxy Node
-        rpcsqa.build_swift_node(node,
-                                swift_roles['storage'],
+        # Build Swift Node
+        rpcsqa.build_swift_node(name,
+                                role,
                                 env,
                                 remote=remote_chef,
                                 chef_config_file=config_file)
 
+    # Proxies and storage nodes only need the management node, so they
+    # all build at once
+    swift_nodes = [(proxy, swift_roles['proxy']) for proxy in swift_proxy] + \
+        [(node, swift_roles['storage']) for node in swift_storage]
+    for swift_node, ret, error in rpcsqa.run_on_nodes(build_swift,
+                                                      swift_nodes):
+        if error is not None:
+            print "## -- Failed to build {0} -- ##".format(swift_node[0])
+            raise error
+
     #####################################################################
     ############### Run chef on management server again #################
     #####################################################################
@@ -16,7 +16,7 @@ def tempest(environment="autotest-precise-grizzly-glance-cf",
     Tests an openstack cluster with tempest
     """
     qa = rpcsqa_helper()
-    env = Environment(environment)
+    env = Environment(environment, api=qa.chef)
     if 'remote_chef' in env.override_attributes:
         api = qa.remote_chef_client(environment)
         env = Environment(environment, api=api)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+from subprocess import Popen, PIPE
+
+# cache of built binary packages, so rebuilding a source that was already
+# built in the same chroot hands back the old .debs and .changes
+#
+#   build_cache.py key <dsc> <chroot> [build settings...]
+#   build_cache.py fetch <key> <dest dir>
+#   build_cache.py store <key> <files...>
+#   build_cache.py evict
+#
+CACHE_DIR=os.environ.get('BUILD_CACHE', '/var/cache/jenkins-deb/binaries')
+MAX_SIZE=int(os.environ.get('BUILD_CACHE_MAX_MB', 20480)) * 1024 * 1024
+MAX_AGE=int(os.environ.get('BUILD_CACHE_MAX_DAYS', 30)) * 24 * 60 * 60
+
+def die(msg):
+    sys.stderr.write('%s\n' % msg)
+    sys.exit(1)
+
+def run(cmd):
+    proc = Popen(cmd, stdout=PIPE)
+    output = proc.communicate()[0]
+    if proc.returncode != 0:
+        die('%s failed' % ' '.join(cmd))
+    return output
+
+def dsc_checksums(path):
+    # the signature changes every time the source is signed, the names,
+    # sizes and hashes of the files it describes only when the source does
+    fields = {}
+    lastheader = ''
+    with open(path) as f:
+        for line in f:
+            line = line.rstrip()
+            if line.startswith('-----BEGIN PGP SIGNATURE'):
+                break
+            if line.startswith(' ') and lastheader:
+                fields[lastheader].append(line.strip())
+            elif ':' in line and not line.startswith('-----'):
+                (header, rest) = line.split(':', 1)
+                lastheader = header.strip()
+                fields[lastheader] = [ rest.strip() ] if rest.strip() else []
+
+    checksums = fields.get('Checksums-Sha256') or fields.get('Files')
+    if not checksums:
+        die('No checksums in %s' % path)
+    return (fields.get('Source', []) + fields.get('Version', []) +
+            sorted(checksums))
+
+def chroot_fingerprint(chroot):
+    # stands in for the hash of the base image, the chroot config and every
+    # package installed in it
+    info = run(['schroot', '-i', '-c', chroot])
+    packages = run(['schroot', '-c', chroot, '--', 'dpkg-query', '-W',
+                    '-f', '${Package} ${Version} ${Architecture}\n'])
+    return [ info, packages ]
+
+def entry_path(key):
+    return os.path.join(CACHE_DIR, key[:2], key)
+
+def key(dsc, chroot, *settings):
+    digest = hashlib.sha256()
+    for part in dsc_checksums(dsc) + chroot_fingerprint(chroot) + list(settings):
+        digest.update(part)
+        digest.update('\0')
+    print digest.hexdigest()
+
+def fetch(key, dest):
+    entry = entry_path(key)
+    try:
+        with open(os.path.join(entry, 'meta.json')) as f:
+            meta = json.load(f)
+    except (IOError, ValueError):
+        sys.exit(1)
+
+    for name in meta['files']:
+        target = os.path.join(dest, name)
+        if os.path.exists(target):
+            os.remove(target)
+        try:
+            os.link(os.path.join(entry, name), target)
+        except OSError:
+            shutil.copy2(os.path.join(entry, name), target)
+        print name
+
+    # eviction goes by the last time an entry was used
+    os.utime(entry, None)
+
+def store(key, *paths):
+    entry = entry_path(key)
+    if not paths or os.path.exists(entry):
+        return
+    if not os.path.exists(os.path.dirname(entry)):
+        try:
+            os.makedirs(os.path.dirname(entry))
+        except OSError:
+            pass
+
+    # build the entry to the side so a fetch never sees half of one
+    tmp_entry = tempfile.mkdtemp(dir=os.path.dirname(entry))
+    size = 0
+    for path in paths:
+        shutil.copy2(path, tmp_entry)
+        os.chmod(os.path.join(tmp_entry, os.path.basename(path)), 0444)
+        size += os.path.getsize(path)
+    with open(os.path.join(tmp_entry, 'meta.json'), 'w') as f:
+        json.dump({'files': [ os.path.basename(path) for path in paths ],
+                   'size': size,
+                   'created': time.time()}, f)
+    os.chmod(tmp_entry, 0755)
+
+    try:
+        os.rename(tmp_entry, entry)
+    except OSError:
+        # another build stored the same key first
+        shutil.rmtree(tmp_entry)
+
+def evict():
+    entries = []
+    for prefix in os.listdir(CACHE_DIR) if os.path.isdir(CACHE_DIR) else []:
+        for key in os.listdir(os.path.join(CACHE_DIR, prefix)):
+            entry = os.path.join(CACHE_DIR, prefix, key)
+            try:
+                with open(os.path.join(entry, 'meta.json')) as f:
+                    size = json.load(f)['size']
+            except (IOError, ValueError, KeyError):
+                # a store that died part way
+                if os.stat(entry).st_mtime < time.time() - 24 * 60 * 60:
+                    shutil.rmtree(entry, True)
+                continue
+            entries.append((os.stat(entry).st_mtime, size, entry))
+
+    # least recently used first
+    entries.sort()
+    total = sum(size for (used, size, entry) in entries)
+    for (used, size, entry) in entries:
+        if used >= time.time() - MAX_AGE and total <= MAX_SIZE:
+            break
+        print 'Evicting %s' % entry
+        shutil.rmtree(entry, True)
+        total -= size
+
+# command -> (function, fewest arguments)
+commands = { 'key': (key, 2), 'fetch': (fetch, 2), 'store': (store, 1), 'evict': (evict, 0) }
+
+if len(sys.argv) < 2 or not sys.argv[1] in commands or len(sys.argv) - 2 < commands[sys.argv[1]][1]:
+    die('Usage: %s key <dsc> <chroot> [settings...] | fetch <key> <dir> | '
+        'store <key> <files...> | evict' % sys.argv[0])
+
+commands[sys.argv[1]][0](*sys.argv[2:])
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+import os
+import re
+import sys
+from multiprocessing.pool import ThreadPool
+from subprocess import call
+
+# imports the incoming packages into the proposed repo, the layout is
+#
+#   <incoming>/<nova_release>/<milestone>/<codename>/.../<package>.{dsc,deb}
+#   <proposed>/<nova_release>-<milestone>/  (one reprepro base per component)
+#
+INCOMING_PACKAGES='/srv/incoming-packages'
+PROPOSED_REPO='/srv/proposed-packages'
+WORKERS=4
+
+def order(char):
+    # dpkg ordering: ~ sorts before everything, even the end of the string,
+    # then letters, then everything else
+    if char == '~':
+        return -1
+    if char == '':
+        return 0
+    if char.isalpha():
+        return ord(char)
+    return ord(char) + 256
+
+def compare_part(first, second):
+    while first or second:
+        first_text = re.match(r'[^\d]*', first).group(0)
+        second_text = re.match(r'[^\d]*', second).group(0)
+        for i in range(max(len(first_text), len(second_text))):
+            diff = order(first_text[i:i + 1]) - order(second_text[i:i + 1])
+            if diff:
+                return diff
+        first = first[len(first_text):]
+        second = second[len(second_text):]
+
+        first_digits = re.match(r'\d*', first).group(0)
+        second_digits = re.match(r'\d*', second).group(0)
+        diff = int(first_digits or 0) - int(second_digits or 0)
+        if diff:
+            return diff
+        first = first[len(first_digits):]
+        second = second[len(second_digits):]
+    return 0
+
+def split_version(version):
+    epoch = 0
+    if ':' in version:
+        (epoch, version) = version.split(':', 1)
+    revision = '0'
+    if '-' in version:
+        (version, revision) = version.rsplit('-', 1)
+    return (int(epoch), version, revision)
+
+def compare_versions(first, second):
+    (first_epoch, first_upstream, first_revision) = split_version(first)
+    (second_epoch, second_upstream, second_revision) = split_version(second)
+    if first_epoch != second_epoch:
+        return first_epoch - second_epoch
+    return (compare_part(first_upstream, second_upstream) or
+            compare_part(first_revision, second_revision))
+
+def parse_package(path):
+    # name_version_arch.deb or name_version.dsc, None for anything else
+    fields = os.path.basename(path).rsplit('.', 1)[0].split('_')
+    if path.endswith('.deb'):
+        if len(fields) < 3:
+            return None
+        return (fields[0], fields[1], fields[2])
+    if len(fields) < 2:
+        return None
+    return (fields[0], fields[1], 'source')
+
+def find_packages(incoming):
+    # (nova_release, milestone, codename) -> { (name, arch): [ (version, path) ] }
+    # and the outcomes of the packages that can't be imported
+    groups = {}
+    rejected = []
+    for root, dirs, files in os.walk(incoming):
+        for filename in files:
+            if not (filename.endswith('.dsc') or filename.endswith('.deb')):
+                continue
+
+            path = os.path.join(root, filename)
+            details = os.path.relpath(path, incoming).split(os.sep)
+            if len(details) < 4:
+                print 'Skipping %s -- not under <release>/<milestone>/<codename>' % path
+                continue
+
+            package = parse_package(path)
+            if package is None:
+                print 'Skipping %s -- not name_version_arch.deb or name_version.dsc' % path
+                rejected.append((path, 'failed'))
+                continue
+
+            (name, version, arch) = package
+            group = groups.setdefault(tuple(details[:3]), {})
+            group.setdefault((name, arch), []).append((version, path))
+    return (groups, rejected)
+
+def newest(candidates):
+    best = candidates[0]
+    for candidate in candidates[1:]:
+        if compare_versions(candidate[0], best[0]) > 0:
+            best = candidate
+    return best
+
+def reprepro(base, component, *args):
+    return call(['reprepro', '-b', base, '-C', component] + list(args))
+
+def import_group(job):
+    # one reprepro base at a time, its database only takes one writer
+    (base, component, groups) = job
+    outcomes = []
+
+    for (codename, packages) in groups:
+        sources = []
+        binaries = []
+        for (name, arch), candidates in sorted(packages.items()):
+            (version, path) = newest(candidates)
+            for (other_version, other_path) in candidates:
+                if other_path != path:
+                    outcomes.append((other_path, 'superseded by %s' % version))
+            if arch == 'source':
+                sources.append(path)
+            else:
+                binaries.append((name, path))
+
+        # includedsc only takes a single .dsc
+        for path in sources:
+            if reprepro(base, component, 'includedsc', codename, path) == 0:
+                outcomes.append((path, 'uploaded'))
+            else:
+                outcomes.append((path, 'failed'))
+
+        if not binaries:
+            continue
+
+        # drop the old binaries so rebuilds of the same version go in, then
+        # add every .deb with one database open
+        names = sorted(set(name for (name, path) in binaries))
+        reprepro(base, component, 'remove', codename, *names)
+
+        paths = [ path for (name, path) in binaries ]
+        if reprepro(base, component, 'includedeb', codename, *paths) == 0:
+            outcomes.extend((path, 'uploaded') for path in paths)
+            continue
+
+        # find out which of the batch was the problem
+        for path in paths:
+            if reprepro(base, component, 'includedeb', codename, path) == 0:
+                outcomes.append((path, 'uploaded'))
+            else:
+                outcomes.append((path, 'failed'))
+
+    return outcomes
+
+if len(sys.argv) > 1:
+    INCOMING_PACKAGES=sys.argv[1]
+if len(sys.argv) > 2:
+    PROPOSED_REPO=sys.argv[2]
+
+# component -> [ (codename, packages) ], components have their own base so
+# they import in parallel
+(groups, rejected) = find_packages(INCOMING_PACKAGES)
+
+jobs = {}
+for (nova_release, milestone, codename), packages in sorted(groups.items()):
+    component = '%s-%s' % (nova_release, milestone)
+    jobs.setdefault(component, []).append((codename, packages))
+
+jobs = [ (os.path.join(PROPOSED_REPO, component), component, groups)
+         for component, groups in sorted(jobs.items()) ]
+
+results = [rejected]
+if jobs:
+    pool = ThreadPool(min(WORKERS, len(jobs)))
+    try:
+        results.extend(pool.map(import_group, jobs))
+    finally:
+        pool.close()
+        pool.join()
+
+summary = {}
+for outcomes in results:
+    for (path, outcome) in outcomes:
+        print '%s: %s' % (outcome, path)
+        status = outcome.split()[0]
+        summary[status] = summary.get(status, 0) + 1
+
+print 'Imported packages: %s' % ', '.join('%d %s' % (count, status) for status, count in sorted(summary.items()))
+
+# let the job see that something didn't make it in
+if summary.get('failed'):
+    sys.exit(1)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+import socket
+import struct
+import sqlite3
+from optparse import OptionParser
+
+# poor-man's IPAM, a sqlite database of the test vm addresses.  A host keeps
+# its address until the job tearing its vm down releases it.  Given a lease
+# time, addresses nobody asked for within it go back to the pool, hosts that
+# should keep theirs renew by allocating again.
+#
+# The first run seeds the database from the old flat file, which looks like
+#
+# 192.168.1.10 unallocated
+# 192.168.1.11 some-host
+#
+# The database runs in WAL mode, so its directory has to be writable by the
+# jobs too, for the -wal and -shm files next to it.
+#
+IP_DB=os.environ.get('IPAM_DB', '/etc/jenkins-deb/jenkins-deb-ip.db')
+IP_CONF=os.environ.get('IPAM_CONF', '/etc/jenkins-deb/jenkins-deb-ip.conf')
+# seconds, 0 for addresses that never expire
+LEASE_TIME=int(os.environ.get('IPAM_LEASE', 0))
+
+SCHEMA = [ '''CREATE TABLE IF NOT EXISTS ips (
+                ip TEXT PRIMARY KEY,
+                addr INTEGER NOT NULL,
+                host TEXT UNIQUE,
+                expires REAL)''',
+           'CREATE INDEX IF NOT EXISTS ips_free ON ips (host, addr)' ]
+
+class IpamError(Exception):
+    pass
+
+def ip_to_int(ip):
+    return struct.unpack('!I', socket.inet_aton(ip))[0]
+
+class Ipam:
+    def __init__(self, path=IP_DB, conf=IP_CONF, lease_time=LEASE_TIME):
+        self.path = path
+        self.conf = conf
+        self.lease_time = lease_time
+
+        # writers only lock the database for the statements of one
+        # allocation, readers never wait on them
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+
+        # the first jobs to run all try to create and seed the database
+        with self.transaction():
+            for statement in SCHEMA:
+                self.db.execute(statement)
+            if self.db.execute('SELECT COUNT(*) FROM ips').fetchone()[0] == 0:
+                if conf and os.path.exists(conf):
+                    self.load_conf(conf)
+
+    def transaction(self):
+        return Transaction(self.db)
+
+    def load_conf(self, conf):
+        with open(conf) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) != 2:
+                    continue
+                (ip, host) = fields
+                if host == 'unallocated':
+                    host = None
+                self.add(ip, host)
+
+    def expires(self):
+        return time.time() + self.lease_time if self.lease_time else None
+
+    def add(self, ip, host=None):
+        # seeded hosts keep their address like they did in the flat file
+        self.db.execute('INSERT OR IGNORE INTO ips (ip, addr, host, expires) VALUES (?, ?, ?, ?)',
+                        (ip, ip_to_int(ip), host, None))
+
+    def lookup(self, host):
+        row = self.db.execute('SELECT ip FROM ips WHERE host = ?', (host,)).fetchone()
+        return row[0] if row else None
+
+    def allocate(self, host):
+        # an address the host already has, then the lowest free address,
+        # then the one whose lease ran out longest ago
+        now = time.time()
+        with self.transaction():
+            ip = self.lookup(host)
+            if ip is None:
+                row = self.db.execute('SELECT ip FROM ips WHERE host IS NULL ORDER BY addr LIMIT 1').fetchone()
+                if row is None:
+                    row = self.db.execute('SELECT ip FROM ips WHERE expires < ? ORDER BY expires LIMIT 1',
+                                          (now,)).fetchone()
+                if row is None:
+                    raise IpamError('No free addresses for %s' % host)
+                ip = row[0]
+
+            self.db.execute('UPDATE ips SET host = ?, expires = ? WHERE ip = ?',
+                            (host, self.expires(), ip))
+        return ip
+
+    def release(self, host):
+        with self.transaction():
+            ip = self.lookup(host)
+            self.db.execute('UPDATE ips SET host = NULL, expires = NULL WHERE host = ?', (host,))
+        return ip
+
+    def expire(self):
+        now = time.time()
+        with self.transaction():
+            expired = [ row[0] for row in self.db.execute('SELECT host FROM ips WHERE expires < ?', (now,)) ]
+            self.db.execute('UPDATE ips SET host = NULL, expires = NULL WHERE expires < ?', (now,))
+        return expired
+
+    def list(self):
+        return self.db.execute('SELECT ip, host, expires FROM ips ORDER BY addr').fetchall()
+
+class Transaction:
+    # BEGIN IMMEDIATE takes the write lock up front, so two allocations can't
+    # both see the same address as free
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        self.db.execute('BEGIN IMMEDIATE')
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.db.execute('COMMIT')
+        else:
+            self.db.execute('ROLLBACK')
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='usage: %prog [options] allocate|lookup|release <host> | expire | list | add <ip>...')
+    parser.add_option('-d', '--db', dest='db', default=IP_DB,
+                      help='sqlite database of the addresses')
+    parser.add_option('-c', '--conf', dest='conf', default=IP_CONF,
+                      help='flat file to seed an empty database from')
+    parser.add_option('-l', '--lease', dest='lease', type='int', default=LEASE_TIME,
+                      help='seconds a host keeps an address it stopped asking for, 0 for ever')
+    (options, args) = parser.parse_args()
+
+    if not args:
+        parser.error('no command given')
+
+    ipam = Ipam(options.db, options.conf, options.lease)
+    (command, args) = (args[0], args[1:])
+
+    try:
+        if command in [ 'allocate', 'lookup', 'release' ]:
+            if len(args) != 1:
+                parser.error('%s takes a host name' % command)
+            ip = getattr(ipam, command)(args[0])
+            if ip is None:
+                sys.exit(1)
+            print ip
+        elif command == 'expire':
+            for host in ipam.expire():
+                print host
+        elif command == 'list':
+            for (ip, host, expires) in ipam.list():
+                print '%s %s' % (ip, host or 'unallocated')
+        elif command == 'add':
+            with ipam.transaction():
+                for ip in args:
+                    ipam.add(ip)
+        else:
+            parser.error('unknown command %s' % command)
+    except IpamError, e:
+        sys.stderr.write('%s\n' % e)
+        sys.exit(1)
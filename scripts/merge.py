@@ -2,6 +2,10 @@
 
 import os
 import sys
+import json
+import hashlib
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 from subprocess import call
 
 # this should probably be pulled from the conf/distributions, but it can't be different across
@@ -9,20 +13,52 @@ from subprocess import call
 #
 SIGNING_KEY='F87CBDE0'
 BASE_DIR='/srv/packages'
+WORKERS=8
+
+# per codename record of the component Release files the merge was built from
+STATE_FILE='.merge-state'
+# signed outputs per codename, the signatures go in place before the Release
+OUTPUTS=[ 'Release.gpg', 'InRelease', 'Release' ]
+
+# checksum sections of a Release file, each line is "<hash> <size> <path>"
+CHECKSUMS=[ ('MD5Sum', hashlib.md5), ('SHA1', hashlib.sha1), ('SHA256', hashlib.sha256) ]
+SECTIONS=[ name for (name, hasher) in CHECKSUMS ]
 
 class ReleaseInfo:
     def __init__(self):
         self.info={}
         self.order=[]
+        # path -> size, a hash per section, the file on disk and the mtime
+        # of the Release that vouched for the hashes
+        self.files=OrderedDict()
         pass
 
     def load(self, path):
+        root = os.path.dirname(path)
+        checked = os.stat(path).st_mtime
+
         with open(path) as f:
             lastheader=''
 
-            for line in f:
+            for lineno, line in enumerate(f, 1):
                 line = line.rstrip()
-                if line.startswith(' '):
+                if not line:
+                    continue
+
+                if line.startswith(' ') and lastheader in SECTIONS:
+                    fields = line.split()
+                    if len(fields) != 3 or not fields[1].isdigit():
+                        raise ValueError('%s:%d: bad %s entry: %s' % (path, lineno, lastheader, line))
+
+                    (digest, size, name) = fields
+                    entry = self.files.setdefault(name, { 'source': os.path.join(root, name),
+                                                          'checked': checked })
+                    if 'size' in entry and entry['size'] != int(size):
+                        # the sections disagree, let update_checksums sort it out
+                        entry['checked'] = 0
+                    entry['size'] = int(size)
+                    entry[lastheader] = digest
+                elif line.startswith(' '):
                     # continuation
                     self.info[lastheader] = self.info[lastheader] + '\n' + line
                 else:
@@ -30,15 +66,22 @@ class ReleaseInfo:
 
                     header = header.strip()
                     rest = rest.strip()
-                    
+
                     lastheader = header
 
                     self.order.append(header)
-                    self.info[header] = rest
+                    if not header in SECTIONS:
+                        self.info[header] = rest
 
     def save(self, fp):
         for header in self.order:
-            fp.write('%s: %s\n' % (header, self.info[header]))
+            if header in SECTIONS:
+                fp.write('%s:\n' % header)
+                for name, entry in self.files.items():
+                    if header in entry:
+                        fp.write(' %s %d %s\n' % (entry[header], entry['size'], name))
+            else:
+                fp.write('%s: %s\n' % (header, self.info[header]))
 
     def dump(self):
         self.save(sys.stdout)
@@ -49,76 +92,203 @@ class ReleaseInfo:
     def get_order(self):
         return self.order
 
+    def get_files(self):
+        return self.files
+
     def merge(self, other):
         otherinfo = other.get_info()
 
-        if self.info == {}:
-            self.info = otherinfo
-            self.order = other.get_order()
+        if self.order == []:
+            self.info = dict(otherinfo)
+            self.order = list(other.get_order())
         else:
-            self.info['Components'] = ' '.join(merge_arrays(self.info['Components'].split(' '), 
-                                                            otherinfo['Components'].split(' ')))
+            for param in [ 'Components', 'Architectures' ]:
+                self.info[param] = ' '.join(merge_arrays(self.info.get(param, '').split(),
+                                                         otherinfo.get(param, '').split()))
+
+            for param in SECTIONS:
+                if param in other.get_order() and not param in self.order:
+                    self.order.append(param)
+
+        # keyed by path, so a file listed by two components is only listed once
+        for name, entry in other.get_files().items():
+            self.files[name] = dict(entry)
+
+    def update_checksums(self):
+        # only hash files that are missing a checksum or changed after the
+        # Release that listed them was written
+        updated = 0
+        for name, entry in self.files.items():
+            try:
+                st = os.stat(entry['source'])
+            except OSError:
+                continue
 
-            self.info['Architectures'] = ' '.join(merge_arrays(self.info['Architectures'].split(' '), 
-                                                               otherinfo['Architectures'].split(' ')))
-            for param in [ 'MD5Sum', 'SHA1', 'SHA256' ]:
-                self.info[param] = self.info[param] + otherinfo[param]
+            if (entry.get('size') == st.st_size and st.st_mtime <= entry['checked'] and
+                    all(section in entry for section in SECTIONS)):
+                continue
+
+            entry.update(checksum_file(entry['source']))
+            entry['checked'] = st.st_mtime
+            updated += 1
+
+        for section in SECTIONS:
+            if self.files and not section in self.order:
+                self.order.append(section)
+
+        return updated
+
+def checksum_file(path):
+    # one read of the file feeds every hash
+    hashers = [ (name, hasher()) for (name, hasher) in CHECKSUMS ]
+    size = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), ''):
+            size += len(chunk)
+            for (name, hasher) in hashers:
+                hasher.update(chunk)
+
+    result = dict((name, hasher.hexdigest()) for (name, hasher) in hashers)
+    result['size'] = size
+    return result
 
 def merge_arrays(first, second):
-    resulting_list = first + [i for i in second if i not in first ]
-    return resulting_list
-        
-if len(sys.argv) > 1:
-    BASE_DIR=sys.argv[1]
+    # ordered set, keeps the first time each item was seen
+    return list(OrderedDict.fromkeys(first + second))
 
-component_list=[ component for component in os.listdir(BASE_DIR) if component.find("-") >= 0 ]
-merge_targets = {}
+def file_state(path, previous=None):
+    # mtime and size are enough when nothing touched the file, otherwise
+    # hash it so a rewrite with the same content still counts as unchanged
+    st = os.stat(path)
+    if previous and previous[:2] == [st.st_mtime, st.st_size]:
+        return previous
+    with open(path) as f:
+        digest = hashlib.sha1(f.read()).hexdigest()
+    return [st.st_mtime, st.st_size, digest]
 
-for component in component_list:
-    codename_list=[ codename for codename in os.listdir(os.path.join(BASE_DIR, component, 'dists')) ]
-    for codename in codename_list:
-        # grab the release info
-        info = ReleaseInfo()
-        info.load(os.path.join(BASE_DIR, component, 'dists', codename, 'Release'))
+def dist_path(codename, *names):
+    return os.path.join(BASE_DIR, 'dists', codename, *names)
 
-        if not codename in merge_targets:
-            merge_targets[codename] = []
+def load_state(codename):
+    try:
+        with open(dist_path(codename, STATE_FILE)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+def save_state(codename, state):
+    with open(dist_path(codename, STATE_FILE + '.new'), 'w') as f:
+        json.dump(state, f)
+    os.rename(dist_path(codename, STATE_FILE + '.new'),
+              dist_path(codename, STATE_FILE))
 
-        merge_targets[codename].append(info)
+def is_current(codename, state, previous):
+    # outputs from an interrupted run don't count
+    for output in OUTPUTS:
+        if not os.path.exists(dist_path(codename, output)):
+            return False
 
-for codename in merge_targets:
+    digests = dict((path, entry[2]) for path, entry in state.items())
+    previous_digests = dict((path, entry[2]) for path, entry in previous.items())
+    return digests == previous_digests
+
+def merge_codename(codename):
     # natty, oneiric, etc
     merged_info = ReleaseInfo()
 
-    for info in merge_targets[codename]:
+    for path in merge_targets[codename]:
+        info = ReleaseInfo()
+        info.load(path)
         merged_info.merge(info)
 
-    if not os.path.exists(os.path.join(BASE_DIR, 'dists')):
-        os.mkdir(os.path.join(BASE_DIR, 'dists'))
+    updated = merged_info.update_checksums()
+    if updated:
+        print 'Updated checksums of %d files for %s' % (updated, codename)
 
-    if not os.path.exists(os.path.join(BASE_DIR, 'dists', codename)):
-        os.mkdir(os.path.join(BASE_DIR, 'dists', codename))
+    if not os.path.exists(dist_path(codename)):
+        os.makedirs(dist_path(codename))
 
-    with open(os.path.join(BASE_DIR, 'dists', codename, 'Release'), 'w') as f:
+    # written to the side, it only replaces the old Release once it is signed
+    with open(dist_path(codename, 'Release.new'), 'w') as f:
         merged_info.save(f)
 
-    if os.path.exists(os.path.join(BASE_DIR, 'dists', codename, 'Release.gpg')):
-        os.remove(os.path.join(BASE_DIR, 'dists', codename, 'Release.gpg'))
+def sign(job):
+    (codename, output, mode) = job
+
+    # the new Release is signed where it sits, publish puts both in place
+    return call(['gpg', '--batch', '--yes', mode] +
+                ([ '--armor' ] if mode == '--detach-sign' else []) +
+                ['--default-key', SIGNING_KEY,
+                 '--output', dist_path(codename, output + '.new'),
+                 dist_path(codename, 'Release.new') ])
+
+def publish(codename, ok):
+    # the three go in place back to back once all of them exist, a failed
+    # signing leaves the old, still matching, set alone
+    for output in OUTPUTS:
+        if ok:
+            os.rename(dist_path(codename, output + '.new'), dist_path(codename, output))
+        elif os.path.exists(dist_path(codename, output + '.new')):
+            os.remove(dist_path(codename, output + '.new'))
+
+def run_pool(func, items):
+    if not items:
+        return []
+    pool = ThreadPool(min(WORKERS, len(items)))
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+        pool.join()
+
+force = '--force' in sys.argv
+args = [ arg for arg in sys.argv[1:] if arg != '--force' ]
+if len(args) > 0:
+    BASE_DIR=args[0]
+
+component_list=sorted([ component for component in os.listdir(BASE_DIR) if component.find("-") >= 0 ])
+merge_targets = {}
+
+for component in component_list:
+    codename_list=sorted(os.listdir(os.path.join(BASE_DIR, component, 'dists')))
+    for codename in codename_list:
+        release = os.path.join(BASE_DIR, component, 'dists', codename, 'Release')
+        if not os.path.exists(release):
+            continue
+
+        if not codename in merge_targets:
+            merge_targets[codename] = []
+
+        merge_targets[codename].append(release)
+
+# only merge and sign the codenames whose component Release files changed
+states = {}
+for codename in sorted(merge_targets):
+    previous = load_state(codename)
+    states[codename] = dict((path, file_state(path, previous.get(path)))
+                            for path in merge_targets[codename])
+    if not force and is_current(codename, states[codename], previous):
+        print 'Release for %s is up to date' % codename
+        del states[codename]
 
-    if os.path.exists(os.path.join(BASE_DIR, 'dists', codename, 'InRelease')):
-        os.remove(os.path.join(BASE_DIR, 'dists', codename, 'InRelease'))
+changed = sorted(states)
+run_pool(merge_codename, changed)
 
-    call(['gpg','--detach-sign', '--armor', '--default-key',
-          SIGNING_KEY, '--output',
-          os.path.join(BASE_DIR, 'dists', codename, 'Release.gpg'),
-          os.path.join(BASE_DIR, 'dists', codename, 'Release') ])
+jobs = []
+for codename in changed:
+    jobs.append((codename, 'Release.gpg', '--detach-sign'))
+    jobs.append((codename, 'InRelease', '--clearsign'))
 
-    call(['gpg','--clearsign', '--default-key',
-          SIGNING_KEY, '--output',
-          os.path.join(BASE_DIR, 'dists', codename, 'InRelease'),
-          os.path.join(BASE_DIR, 'dists', codename, 'Release') ])
+failed = set()
+for job, ret in zip(jobs, run_pool(sign, jobs)):
+    if ret != 0:
+        print 'Failed to sign %s for %s' % (job[1], job[0])
+        failed.add(job[0])
 
-                           
-                                                                        
-                                                                        
+for codename in changed:
+    publish(codename, not codename in failed)
+    if not codename in failed:
+        save_state(codename, states[codename])
 
+if failed:
+    sys.exit(1)